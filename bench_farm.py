@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+bench_farm.py — воспроизводимый бенчмарк опроса на локальной "ферме" TCP-целей:
+- instant — слушатель с большим backlog, accept сразу
+- slow — маленький backlog и медленный accept: часть SYN теряется, connect ждёт ретрансмита
+- refuse — порт занят, но не слушает: RST на SYN
+- blackhole — очередь accept переполнена: SYN без ответа, connect уходит в таймаут
+- reset — accept и сразу RST (SO_LINGER 0)
+
+Генерирует hosts.yaml на 10 / 1k / 10k целей (адреса 127.x.y.z, Linux отвечает на весь 127/8),
+запускает monitor.main() в отдельном процессе для каждого движка и печатает время цикла,
+CPU и пиковый RSS процесса монитора. Слушатели привязаны к 0.0.0.0 на время прогона.
+"""
+import os
+import argparse
+import re
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+KINDS = ("instant", "slow", "refuse", "blackhole", "reset")
+DEFAULT_MIX = "instant=70,slow=10,refuse=10,blackhole=5,reset=5"
+
+
+def listener(backlog):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", 0))
+    sock.listen(backlog)
+    return sock
+
+
+def accept_loop(sock, delay=0.0, reset=False):
+    while True:
+        try:
+            conn, _ = sock.accept()
+        except OSError:
+            return
+        if reset:
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        conn.close()
+        if delay:
+            time.sleep(delay)
+
+
+class Farm:
+    # Один порт на вид цели; разные цели одного вида различаются адресом 127.x.y.z
+    def __init__(self, slow_backlog=4, slow_accept_ms=20):
+        self.socks = []
+        self.ports = {}
+
+        sock = listener(socket.SOMAXCONN)
+        self.start(sock, "instant")
+        sock = listener(slow_backlog)
+        self.start(sock, "slow", delay=slow_accept_ms / 1000)
+        sock = listener(socket.SOMAXCONN)
+        self.start(sock, "reset", reset=True)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("0.0.0.0", 0))   # занят, но без listen — ядро отвечает RST
+        self.add(sock, "refuse")
+
+        # Без accept и с заполненной очередью новые SYN молча отбрасываются
+        sock = listener(0)
+        self.add(sock, "blackhole")
+        for _ in range(4):
+            filler = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            filler.setblocking(False)
+            filler.connect_ex(("127.0.0.1", self.ports["blackhole"]))
+            self.socks.append(filler)
+        time.sleep(0.2)
+
+    def add(self, sock, kind):
+        self.socks.append(sock)
+        self.ports[kind] = sock.getsockname()[1]
+
+    def start(self, sock, kind, delay=0.0, reset=False):
+        self.add(sock, kind)
+        threading.Thread(target=accept_loop, args=(sock, delay, reset), daemon=True).start()
+
+    def close(self):
+        for sock in self.socks:
+            sock.close()
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in KINDS:
+            raise ValueError(f"unknown target kind {kind!r}, expected one of {', '.join(KINDS)}")
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+def target_kinds(count, mix):
+    # Детерминированная раскладка: доли из mix, виды перемешаны по порядку целей
+    total = sum(mix.values())
+    kinds, acc = [], {k: 0.0 for k in mix}
+    for _ in range(count):
+        for k in mix:
+            acc[k] += mix[k] / total
+        kind = max(acc, key=acc.get)
+        acc[kind] -= 1
+        kinds.append(kind)
+    return kinds
+
+
+def target_addr(i):
+    # 127.1.0.1 ... — 254 адреса на /24, без .0 и .255
+    n = i // 254
+    return f"127.{1 + n // 256}.{n % 256}.{1 + i % 254}"
+
+
+def write_hosts(path, count, mix, ports):
+    lines = []
+    for i, kind in enumerate(target_kinds(count, mix)):
+        lines.append(f"- name: {kind}-{i}\n  host: {target_addr(i)}\n  port: {ports[kind]}\n")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+
+
+def run_monitor(workdir, env, log):
+    # -> (время цикла из лога, wall, CPU user+sys, пиковый RSS в МБ) процесса монитора
+    repo = os.path.dirname(os.path.abspath(__file__))
+    child_env = dict(os.environ, **env)
+    child_env["PYTHONPATH"] = repo + os.pathsep + child_env.get("PYTHONPATH", "")
+    t0 = time.monotonic()
+    with open(log, "w", encoding="utf-8") as out:
+        proc = subprocess.Popen([sys.executable, "-c", "import monitor; monitor.main([])"],
+                                cwd=workdir, env=child_env, stdout=out, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.monotonic() - t0
+    with open(log, "r", encoding="utf-8") as f:
+        m = re.search(r"Probed \d+ hosts in ([\d.]+)s", f.read())
+    rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return (float(m.group(1)) if m else None, wall, usage.ru_utime + usage.ru_stime, rss_mb,
+            proc.returncode)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark monitor.py against a local TCP target farm")
+    parser.add_argument("--sizes", default="10,1000,10000", help="размеры hosts.yaml через запятую")
+    parser.add_argument("--engines", default="async,batch,threads", help="значения PROBE_ENGINE через запятую")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"доли видов целей (по умолчанию {DEFAULT_MIX})")
+    parser.add_argument("--cycles", type=int, default=2,
+                        help="запусков подряд на общем состоянии (первый — холодный)")
+    parser.add_argument("--timeout", default="1.0", help="CONNECT_TIMEOUT для монитора")
+    parser.add_argument("--slow-backlog", type=int, default=4)
+    parser.add_argument("--slow-accept-ms", type=float, default=20.0)
+    parser.add_argument("--keep", action="store_true", help="не удалять рабочие каталоги и логи")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="доп. переменные окружения монитора (можно несколько)")
+    args = parser.parse_args(argv)
+
+    mix = parse_mix(args.mix)
+    extra = dict(item.split("=", 1) for item in args.env)
+    farm = Farm(args.slow_backlog, args.slow_accept_ms)
+    print(f"[INFO] Farm ports: {farm.ports}")
+    print(f"{'hosts':>7} {'engine':>8} {'cycle':>5} {'probe s':>8} {'wall s':>7} {'cpu s':>7} {'rss MB':>7}")
+    try:
+        for size in (int(s) for s in args.sizes.split(",")):
+            for engine in args.engines.split(","):
+                workdir = tempfile.mkdtemp(prefix=f"farm-{size}-{engine}-")
+                write_hosts(os.path.join(workdir, "hosts.yaml"), size, mix, farm.ports)
+                env = dict({"PROBE_ENGINE": engine, "DRY_RUN": "true", "CONNECT_TIMEOUT": args.timeout},
+                           **extra)
+                for cycle in range(1, args.cycles + 1):
+                    log = os.path.join(workdir, f"cycle{cycle}.log")
+                    probe, wall, cpu, rss, code = run_monitor(workdir, env, log)
+                    probe_s = f"{probe:.2f}" if probe is not None else "?"
+                    note = f"  exit={code}, see {log}" if code else ""
+                    print(f"{size:>7} {engine:>8} {cycle:>5} {probe_s:>8} {wall:>7.2f} {cpu:>7.2f} {rss:>7.1f}{note}",
+                          flush=True)
+                if args.keep:
+                    print(f"[INFO] kept {workdir}")
+                else:
+                    shutil.rmtree(workdir, ignore_errors=True)
+    finally:
+        farm.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,17 +2,40 @@
 """
 monitor.py — TCP monitor:
 - читает hosts.yaml
-- сохраняет состояния в statuses.json
+- сохраняет состояния в statuses.json (+ журнал изменений statuses.journal.jsonl)
 - hysteresis (FAIL_THRESHOLD / RECOVERY_THRESHOLD)
 - локальные повторы (RETRIES_PER_CHECK)
+- параллельный опрос хостов (PROBE_ENGINE / PROBE_CONCURRENCY)
 - отправляет Telegram уведомления (OFFLINE и ONLINE)
 - при ONLINE указывает, сколько был офлайн
+- при падении общего релея (ngrok) — одно сообщение вместо алерта на каждый хост
+- режим --daemon: циклы по своему таймеру, состояние в памяти
 """
 
 import os
+import argparse
+import base64
+import copy
+import errno
+import hashlib
+import heapq
+import itertools
 import socket
+import selectors
+import signal
+import sqlite3
+import struct
 import json
+import math
+import queue
+import re
+import sys
 import time
+import asyncio
+import threading
+from array import array
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 import requests
 
@@ -24,17 +47,130 @@ except Exception:
 # Файлы
 HOSTS_FILE = "hosts.yaml"
 STATUS_FILE = "statuses.json"
+JOURNAL_FILE = "statuses.journal.jsonl"
+JOURNAL_META_KEY = "__journal__"   # служебная запись снапшота: до какого seq он включает журнал
+# Счётчики и метки времени меняются каждый цикл — держим их вне git (кэш CI), см. STATE_SPLIT
+VOLATILE_FILE = os.getenv("VOLATILE_FILE", ".cache/statuses.volatile.json")
 
 # Секреты / env (в workflow передаём secrets как env)
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
+# Адрес Bot API; для нагрузочных тестов — локальная заглушка tg_stub.py
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+TELEGRAM_TIMEOUT = float(os.getenv("TELEGRAM_TIMEOUT", "10"))
+# Уведомления отправляет фоновый поток; в конце прогона ждём отправки не дольше этого
+TELEGRAM_DRAIN_SEC = float(os.getenv("TELEGRAM_DRAIN_SEC", "30"))
+# Неотправленные уведомления переживают перезапуск: лежат в outbox рядом с состоянием
+# и повторяются с экспоненциальной паузой (на 429 — ровно столько, сколько просит Telegram)
+OUTBOX_FILE = os.getenv("OUTBOX_FILE", "statuses.outbox.json")
+OUTBOX_BACKOFF_SEC = float(os.getenv("OUTBOX_BACKOFF_SEC", "5"))
+OUTBOX_BACKOFF_MAX_SEC = float(os.getenv("OUTBOX_BACKOFF_MAX_SEC", "3600"))
+OUTBOX_SENT_KEEP = int(os.getenv("OUTBOX_SENT_KEEP", "500"))   # ключи отправленных — против дублей
+
+def parse_duration(value):
+    # 90, "90", "90s", "5m", "1h30m" -> секунды
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip().lower().replace(" ", "")
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    parts = re.findall(r"(\d+(?:\.\d+)?)([hms])", text)
+    if not parts or "".join(n + u for n, u in parts) != text:
+        raise ValueError(f"bad duration {value!r}")
+    return sum(float(n) * {"h": 3600, "m": 60, "s": 1}[u] for n, u in parts)
+
+def parse_threshold(value):
+    # "3" — столько проверок подряд; "90s", "5m" — столько времени подряд -> (count, seconds)
+    text = str(value).strip().lower()
+    if text.isdigit():
+        return int(text), None
+    return None, parse_duration(text)
 
 # Параметры мониторинга (можно переопределять через env)
-FAIL_THRESHOLD = int(os.getenv("FAIL_THRESHOLD", "3"))        # N подряд фейлов -> offline
-RECOVERY_THRESHOLD = int(os.getenv("RECOVERY_THRESHOLD", "2"))# M подряд успехов -> online
+# Пороги — числом проверок ("3") или длительностью ("90s", "5m"): длительность считается
+# по меткам времени проверок и не зависит от того, как часто срабатывает cron
+FAIL_THRESHOLD, FAIL_AFTER_SEC = parse_threshold(os.getenv("FAIL_THRESHOLD", "3"))              # N подряд фейлов -> offline
+RECOVERY_THRESHOLD, RECOVER_AFTER_SEC = parse_threshold(os.getenv("RECOVERY_THRESHOLD", "2"))   # M подряд успехов -> online
 RETRIES_PER_CHECK = int(os.getenv("RETRIES_PER_CHECK", "2"))  # локальные повторы
 RETRY_DELAY_SEC = float(os.getenv("RETRY_DELAY_SEC", "0.7"))
 CONNECT_TIMEOUT = float(os.getenv("CONNECT_TIMEOUT", "3.0"))
+# Хеджирование повторов: следующая попытка стартует через HEDGE_DELAY_SEC, не дожидаясь
+# таймаута предыдущей, побеждает первый успех. 0 — старые последовательные повторы с RETRY_DELAY_SEC
+HEDGE_DELAY_SEC = float(os.getenv("HEDGE_DELAY_SEC", "0.5"))
+PROBE_WORKERS = int(os.getenv("PROBE_WORKERS", "16"))          # потоки для PROBE_ENGINE=threads
+
+# Адаптивный таймаут connect по истории RTT хоста (вместо CONNECT_TIMEOUT для всех);
+# CONNECT_TIMEOUT остаётся для хостов, у которых ещё нет ни одного успешного замера.
+# Нижняя граница — чуть больше 1 с (первый ретрансмит SYN в Linux): быстрый хост получает
+# таймаут меньше CONNECT_TIMEOUT, а потерю одного SYN дополнительно страхует хеджированная попытка
+ADAPTIVE_TIMEOUT = os.getenv("ADAPTIVE_TIMEOUT", "true").lower() in ("1","true","yes")
+ADAPTIVE_TIMEOUT_MIN = float(os.getenv("ADAPTIVE_TIMEOUT_MIN", "1.5"))
+ADAPTIVE_TIMEOUT_MAX = float(os.getenv("ADAPTIVE_TIMEOUT_MAX", "10.0"))
+
+# Движок опроса: async — все хосты параллельно, threads — пул потоков,
+# batch — неблокирующие сокеты + selectors (для тысяч целей), serial — по одному (старое поведение)
+PROBE_ENGINE = os.getenv("PROBE_ENGINE", "async").lower()
+PROBE_CONCURRENCY = int(os.getenv("PROBE_CONCURRENCY", "64"))  # макс. одновременных проверок
+PROBE_BATCH_SIZE = int(os.getenv("PROBE_BATCH_SIZE", "512"))   # макс. открытых сокетов в batch-движке
+
+# Классы ошибок без локальных повторов (refused, timeout, unreachable, dns, dns_temp, reset, error).
+# dns — имя не существует (NXDOMAIN), dns_temp — временный сбой резолвера (EAI_AGAIN и т.п.)
+FAIL_FAST_ERRORS = {c.strip() for c in os.getenv("FAIL_FAST_ERRORS", "refused,dns").lower().split(",") if c.strip()}
+
+# Кэш DNS: ngrok-релеи общие для многих хостов, резолвим каждое имя один раз
+DNS_CACHE_TTL = float(os.getenv("DNS_CACHE_TTL", "60"))        # сек, для успешных ответов
+DNS_NEGATIVE_TTL = float(os.getenv("DNS_NEGATIVE_TTL", "30"))  # сек, только для NXDOMAIN (временные сбои не кэшируем)
+
+# Быстрое подтверждение: после первого фейла — до CONFIRM_PROBES перепроверок
+# с шагом CONFIRM_DELAY_SEC в том же запуске (0 — выключено, ждём следующего цикла)
+CONFIRM_PROBES = int(os.getenv("CONFIRM_PROBES", "0"))
+CONFIRM_DELAY_SEC = float(os.getenv("CONFIRM_DELAY_SEC", "5"))
+
+# Daemon-режим (--daemon): интервал между циклами и как часто сохранять statuses.json
+CHECK_INTERVAL_SEC = float(os.getenv("CHECK_INTERVAL_SEC", "300"))   # по умолчанию, если у хоста нет interval
+PERSIST_INTERVAL_SEC = float(os.getenv("PERSIST_INTERVAL_SEC", "60"))
+SCHEDULE_SLACK_SEC = 0.2   # проверки, до которых осталось меньше — запускаем вместе с текущими
+
+# Уведомления цикла уходят одним сводным сообщением (с разбиением по лимиту Telegram);
+# в daemon-режиме новые события копятся до DIGEST_WINDOW_SEC от первого из них
+DIGEST_WINDOW_SEC = parse_duration(os.getenv("DIGEST_WINDOW_SEC", "30"))
+TELEGRAM_MAX_MESSAGE = 4096
+DIGEST_HEADER_RESERVE = 64
+
+# Корреляция по релеям: если за одним hostname (ngrok-релей) не меньше RELAY_MIN_TARGETS целей
+# и в цикле упала доля >= RELAY_FAIL_RATIO — одно сообщение "relay down" вместо алерта на каждый хост
+RELAY_MIN_TARGETS = int(os.getenv("RELAY_MIN_TARGETS", "3"))
+RELAY_FAIL_RATIO = float(os.getenv("RELAY_FAIL_RATIO", "0.8"))
+RELAYS_KEY = "__relays__"   # служебная запись в statuses.json
+
+# Закреплённое сообщение-табло со статусом всех хостов: правится через editMessageText,
+# и только если его текст изменился (хэш хранится в служебной записи BOARD_KEY)
+STATUS_BOARD = os.getenv("STATUS_BOARD", "false").lower() in ("1","true","yes")
+BOARD_KEY = "__board__"
+
+# Где хранить состояние: json — statuses.json (+ журнал), sqlite — STATE_DB в режиме WAL
+STATE_BACKEND = os.getenv("STATE_BACKEND", "json").lower()
+STATE_DB = os.getenv("STATE_DB", "statuses.db")
+
+# Журнал изменений вместо перезаписи statuses.json на каждом цикле;
+# снапшот пересобирается, когда журнал вырастает до JOURNAL_COMPACT_BYTES
+STATE_JOURNAL = os.getenv("STATE_JOURNAL", "true").lower() in ("1","true","yes")
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", str(256 * 1024)))
+
+# В statuses.json (в git) — только то, что меняется при смене состояния;
+# остальные поля записи — в VOLATILE_FILE, чтобы не коммитить каждый цикл
+STATE_SPLIT = os.getenv("STATE_SPLIT", "true").lower() in ("1","true","yes")
+DURABLE_FIELDS = {"name", "host", "port", "group", "paths", "combined", "offline_since", "suppressed_by"}
+
+# Сколько последних проверок хранить в истории хоста (288 = сутки при проверке раз в 5 минут)
+HISTORY_SIZE = int(os.getenv("HISTORY_SIZE", "288"))
+
+# Гистограмма задержек: сколько замеров помнить (дальше счётчики делятся пополам) и
+# порог p95 в мс, выше которого отвечающий хост считается degraded (0 — выключено)
+LATENCY_WINDOW = int(os.getenv("LATENCY_WINDOW", "1000"))
+DEGRADED_RTT_MS = float(os.getenv("DEGRADED_RTT_MS", "0"))
 
 # Если true — не отправляем в телеграм (для тестов)
 DRY_RUN = os.getenv("DRY_RUN", "false").lower() in ("1","true","yes")
@@ -63,56 +199,1046 @@ def load_hosts():
             name = item.get("name") or f"{item.get('host')}:{item.get('port')}"
             host = item.get("host")
             port = int(item.get("port") or 3389)
-            out.append({"name": str(name), "host": str(host), "port": int(port)})
+            group = item.get("group")   # машина: несколько путей (ddns / ngrok) к одному ПК
+            interval = None             # свой интервал проверки в daemon-режиме: 15, "15s", "10m"
+            if item.get("interval") is not None:
+                try:
+                    interval = parse_duration(item["interval"])
+                except ValueError as e:
+                    print(f"[WARN] {name}: {e}, using default interval")
+            out.append({"name": str(name), "host": str(host), "port": int(port),
+                        "group": str(group) if group else None, "interval": interval})
         return out
 
-def load_statuses():
-    if not os.path.exists(STATUS_FILE):
-        return {}
+# Журнал состояния: statuses.json — снапшот, JOURNAL_FILE — дописываемые построчно изменения
+# по хостам ({"seq", "k", "set"/"unset"} или {"seq", "k", "del"}). Снапшот помнит seq,
+# до которого он включает журнал, поэтому обрыв на любом шаге не портит состояние
+_journal_seq = 0
+_persisted = {}   # key -> запись на момент последнего сохранения (для diff)
+
+def file_size(path):
     try:
-        with open(STATUS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def write_json_atomic(path, data):
+    # Пишем во временный файл и подменяем: при kill остаётся либо старая, либо новая версия
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def apply_journal_entry(statuses, entry):
+    key = entry["k"]
+    if entry.get("del"):
+        statuses.pop(key, None)
+        return
+    rec = statuses.setdefault(key, {})
+    rec.update(entry.get("set") or {})
+    for field in entry.get("unset") or []:
+        rec.pop(field, None)
+
+def replay_journal(statuses, base_seq):
+    # -> (последний seq, был ли оборван хвост журнала)
+    seq, applied = base_seq, 0
+    if not os.path.exists(JOURNAL_FILE):
+        return seq, False
+    with open(JOURNAL_FILE, "r", encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                print(f"[WARN] {JOURNAL_FILE}: truncated entry at line {n}, ignoring the rest")
+                return seq, True
+            if entry.get("seq", 0) <= base_seq:
+                continue   # уже есть в снапшоте
+            apply_journal_entry(statuses, entry)
+            seq = entry["seq"]
+            applied += 1
+    if applied:
+        print(f"[INFO] Replayed {applied} journal entries from {JOURNAL_FILE}")
+    return seq, False
+
+def journal_entries(statuses):
+    # Только изменившиеся поля изменившихся записей
+    for key, rec in statuses.items():
+        old = _persisted.get(key)
+        if old == rec:
+            continue
+        if old is None:
+            yield {"k": key, "set": rec}
+            continue
+        entry = {"k": key, "set": {f: v for f, v in rec.items() if f not in old or old[f] != v}}
+        unset = [f for f in old if f not in rec]
+        if unset:
+            entry["unset"] = unset
+        yield entry
+    for key in _persisted:
+        if key not in statuses:
+            yield {"k": key, "del": True}
+
+def compact_journal(statuses):
+    snapshot = dict(statuses)
+    snapshot[JOURNAL_META_KEY] = {"seq": _journal_seq}
+    write_json_atomic(STATUS_FILE, snapshot)
+    # Снапшот уже включает всё до _journal_seq — обрыв до очистки журнала безопасен
+    with open(JOURNAL_FILE, "w", encoding="utf-8"):
+        pass
+
+def split_statuses(statuses):
+    # -> (durable, volatile); служебные записи целиком durable
+    if not STATE_SPLIT:
+        return statuses, {}
+    durable, volatile = {}, {}
+    for key, rec in statuses.items():
+        if is_meta_key(key):
+            durable[key] = rec
+            continue
+        durable[key] = {f: v for f, v in rec.items() if f in DURABLE_FIELDS}
+        rest = {f: v for f, v in rec.items() if f not in DURABLE_FIELDS}
+        if rest:
+            volatile[key] = rest
+    return durable, volatile
+
+def load_volatile(statuses):
+    if not os.path.exists(VOLATILE_FILE):
+        return
+    try:
+        with open(VOLATILE_FILE, "r", encoding="utf-8") as f:
+            volatile = json.load(f)
     except Exception as e:
-        print("[WARN] failed to load statuses.json:", e)
+        print(f"[WARN] failed to load {VOLATILE_FILE}:", e)
+        return
+    for key, rest in volatile.items():
+        if key in statuses:
+            statuses[key].update(rest)
+
+def save_volatile(volatile):
+    os.makedirs(os.path.dirname(VOLATILE_FILE) or ".", exist_ok=True)
+    write_json_atomic(VOLATILE_FILE, volatile)
+
+def load_statuses_json():
+    global _journal_seq, _persisted
+    statuses = {}
+    if os.path.exists(STATUS_FILE):
+        try:
+            with open(STATUS_FILE, "r", encoding="utf-8") as f:
+                statuses = json.load(f)
+        except Exception as e:
+            print("[WARN] failed to load statuses.json:", e)
+    base_seq = (statuses.pop(JOURNAL_META_KEY, None) or {}).get("seq", 0)
+    # Журнал проигрываем всегда, даже при STATE_JOURNAL=false — чтобы переключение не теряло данных
+    _journal_seq, truncated = replay_journal(statuses, base_seq)
+    _persisted = copy.deepcopy(statuses)
+    if truncated:
+        # Новые записи нельзя дописывать за оборванной строкой — сразу сворачиваем журнал
+        compact_journal(statuses)
+    if STATE_SPLIT:
+        load_volatile(statuses)
+    return statuses
+
+def save_statuses_json(statuses):
+    global _journal_seq, _persisted
+    durable, volatile = split_statuses(statuses)
+    try:
+        if not STATE_JOURNAL:
+            write_json_atomic(STATUS_FILE, durable)
+            if os.path.exists(JOURNAL_FILE):
+                os.remove(JOURNAL_FILE)
+        else:
+            lines = []
+            for entry in journal_entries(durable):
+                _journal_seq += 1
+                entry["seq"] = _journal_seq
+                lines.append(json.dumps(entry, ensure_ascii=False, separators=(",", ":")))
+            if lines:
+                with open(JOURNAL_FILE, "a", encoding="utf-8") as f:
+                    f.write("\n".join(lines) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+            if not os.path.exists(STATUS_FILE) or file_size(JOURNAL_FILE) >= JOURNAL_COMPACT_BYTES:
+                compact_journal(durable)
+        _persisted = copy.deepcopy(durable)
+        if STATE_SPLIT:
+            save_volatile(volatile)
+    except Exception as e:
+        print("[ERROR] failed to save statuses.json:", e)
+
+# SQLite (WAL): построчные upsert'ы изменившихся записей в одной транзакции на цикл;
+# WAL позволяет дашбордам и sqlite3 CLI читать базу, пока монитор пишет
+_db = None
+
+STATE_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS statuses (
+    key      TEXT PRIMARY KEY,
+    name     TEXT,
+    host     TEXT,
+    port     INTEGER,
+    combined TEXT,
+    grp      TEXT,
+    data     TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_statuses_combined ON statuses(combined);
+CREATE INDEX IF NOT EXISTS idx_statuses_grp ON statuses(grp);
+"""
+
+def state_db():
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(STATE_DB, isolation_level=None)   # транзакции открываем сами
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.executescript(STATE_DB_SCHEMA)
+    return _db
+
+def load_statuses_sqlite():
+    global _persisted
+    try:
+        rows = state_db().execute("SELECT key, data FROM statuses").fetchall()
+    except Exception as e:
+        print(f"[WARN] failed to load {STATE_DB}:", e)
         return {}
+    if not rows and (os.path.exists(STATUS_FILE) or os.path.exists(JOURNAL_FILE)):
+        # Первый запуск на sqlite — берём состояние из statuses.json (+ журнал),
+        # в базу оно целиком попадёт при первом сохранении
+        statuses = load_statuses_json()
+        _persisted = {}
+        print(f"[INFO] Seeded {STATE_DB} from {STATUS_FILE}: {len(statuses)} records")
+        return statuses
+    statuses = {key: json.loads(data) for key, data in rows}
+    _persisted = copy.deepcopy(statuses)
+    if STATE_SPLIT:
+        load_volatile(statuses)
+    return statuses
+
+def save_statuses_sqlite(statuses):
+    # Как и в json: в базе только durable-поля, строка меняется лишь при смене состояния
+    global _persisted
+    durable, volatile = split_statuses(statuses)
+    rows = [(key, rec.get("name"), rec.get("host"), rec.get("port"), rec.get("combined"),
+             rec.get("group"), json.dumps(rec, ensure_ascii=False))
+            for key, rec in durable.items() if _persisted.get(key) != rec]
+    gone = [(key,) for key in _persisted if key not in durable]
+    try:
+        db = state_db()
+        db.execute("BEGIN")
+        db.executemany(
+            "INSERT INTO statuses (key, name, host, port, combined, grp, data) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET name=excluded.name, host=excluded.host, port=excluded.port, "
+            "combined=excluded.combined, grp=excluded.grp, data=excluded.data", rows)
+        db.executemany("DELETE FROM statuses WHERE key = ?", gone)
+        db.execute("COMMIT")
+    except Exception as e:
+        if _db is not None and _db.in_transaction:
+            _db.execute("ROLLBACK")
+        print(f"[ERROR] failed to save {STATE_DB}:", e)
+        return
+    _persisted = copy.deepcopy(durable)
+    if STATE_SPLIT:
+        save_volatile(volatile)
+
+def close_state_db():
+    # Закрытие последнего соединения переносит WAL в основной файл — statuses.db можно коммитить
+    global _db
+    if _db is not None:
+        _db.close()
+        _db = None
+
+# Хранилище состояния: STATE_BACKEND -> (load, save)
+STATE_BACKENDS = {
+    "json": (load_statuses_json, save_statuses_json),
+    "sqlite": (load_statuses_sqlite, save_statuses_sqlite),
+}
+
+def state_backend():
+    if STATE_BACKEND not in STATE_BACKENDS:
+        print(f"[WARN] unknown STATE_BACKEND '{STATE_BACKEND}', using json")
+        return STATE_BACKENDS["json"]
+    return STATE_BACKENDS[STATE_BACKEND]
+
+def load_statuses():
+    return state_backend()[0]()
 
 def save_statuses(statuses):
+    # Кольцевые буферы истории живут в памяти; в запись кладём их компактную копию
+    for key, hist in _histories.items():
+        if key in statuses:
+            statuses[key]["history"] = hist.encode()
+    for key, lat in _latencies.items():
+        if key in statuses:
+            statuses[key]["latency"] = lat.encode()
+    state_backend()[1](statuses)
+    save_outbox()
+
+# hostname -> (expires_at, [(family, type, proto, sockaddr)] или None, ошибка или None)
+_dns_cache = {}
+_dns_locks = defaultdict(threading.Lock)
+
+def _dns_cached(host):
+    entry = _dns_cache.get(host)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry
+    return None
+
+def _with_port(sockaddr, port):
+    # sockaddr IPv4 — (ip, port), IPv6 — (ip, port, flowinfo, scope_id)
+    return (sockaddr[0], int(port)) + tuple(sockaddr[2:])
+
+def resolve_cached(host, port):
+    # Как getaddrinfo, но с кэшем по имени (TTL + негативное кэширование).
+    # Ошибка резолва из кэша пробрасывается так же, как от getaddrinfo
+    entry = _dns_cached(host)
+    if entry is None:
+        # Лок на имя: параллельные пробы одного релея ждут один запрос, а не шлют свои
+        with _dns_locks[host]:
+            entry = _dns_cached(host)
+            if entry is None:
+                try:
+                    infos = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+                    addrs = [(fam, typ, proto, sa) for fam, typ, proto, _, sa in infos]
+                    entry = (time.monotonic() + DNS_CACHE_TTL, addrs, None)
+                except socket.gaierror as e:
+                    if classify_error(e) != "dns":
+                        # EAI_AGAIN и прочие временные сбои — следующая проба спросит резолвер снова
+                        raise
+                    entry = (time.monotonic() + DNS_NEGATIVE_TTL, None, e)
+                _dns_cache[host] = entry
+    if entry[2] is not None:
+        raise entry[2]
+    return [(fam, typ, proto, _with_port(sa, port)) for fam, typ, proto, sa in entry[1]]
+
+async def resolve_cached_async(host, port):
+    # Попадание в кэш — без переключения в поток; промах резолвим в executor
+    if _dns_cached(host) is None:
+        return await asyncio.get_running_loop().run_in_executor(None, resolve_cached, host, port)
+    return resolve_cached(host, port)
+
+# Классы ошибок проверки: refused, timeout, unreachable, dns, dns_temp, reset, error (всё прочее)
+_ERRNO_CLASSES = {
+    errno.ECONNREFUSED: "refused",
+    errno.ETIMEDOUT: "timeout",
+    errno.ECONNRESET: "reset",
+    errno.ECONNABORTED: "reset",
+    errno.EPIPE: "reset",
+    errno.ENETUNREACH: "unreachable",
+    errno.EHOSTUNREACH: "unreachable",
+    errno.ENETDOWN: "unreachable",
+    getattr(errno, "EHOSTDOWN", errno.EHOSTUNREACH): "unreachable",
+}
+
+def classify_errno(err):
+    return _ERRNO_CLASSES.get(err, "error")
+
+# Ответы резолвера "такого имени нет" — повтор через секунду ничего не изменит
+_DNS_PERMANENT = {socket.EAI_NONAME, getattr(socket, "EAI_NODATA", socket.EAI_NONAME)}
+
+def classify_error(exc):
+    if isinstance(exc, socket.gaierror):
+        return "dns" if exc.errno in _DNS_PERMANENT else "dns_temp"
+    if isinstance(exc, (socket.timeout, asyncio.TimeoutError)):
+        return "timeout"
+    if isinstance(exc, OSError) and exc.errno is not None:
+        return classify_errno(exc.errno)
+    return "error"
+
+def probe_result(ok, error=None, rtt_ms=None, tcp_info=None):
+    # rtt_ms — время установки соединения, tcp_info — данные ядра о нём (только для успешных проверок)
+    return {"ok": bool(ok), "error": None if ok else (error or "error"),
+            "rtt_ms": round(rtt_ms, 3) if ok and rtt_ms is not None else None,
+            "tcp_info": tcp_info if ok else None}
+
+# struct tcp_info из linux/tcp.h: 8 полей u8, затем u32 (tcpi_rto ... tcpi_total_retrans)
+_TCP_INFO = struct.Struct("8B24I")
+
+def read_tcp_info(sock):
+    # Linux: RTT и его разброс по оценке ядра, RTO и число ретрансмитов (включая SYN)
+    # сразу после connect — один getsockopt. На других ОС — None
+    if not hasattr(socket, "TCP_INFO") or sock is None:
+        return None
+    try:
+        raw = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, _TCP_INFO.size)
+    except OSError:
+        return None
+    if len(raw) < _TCP_INFO.size:
+        return None
+    fields = _TCP_INFO.unpack(raw)
+    u32 = fields[8:]
+    return {"rtt_us": u32[15], "rttvar_us": u32[16], "rto_us": u32[0], "total_retrans": u32[23]}
+
+def should_retry(res):
+    # Детерминированные ошибки (FAIL_FAST_ERRORS) через RETRY_DELAY_SEC не изменятся
+    return not res["ok"] and res["error"] not in FAIL_FAST_ERRORS
+
+def tcp_probe(host, port, timeout=CONNECT_TIMEOUT):
+    # Аналог socket.create_connection, но адреса берём из кэша DNS, а ошибку классифицируем
     try:
-        with open(STATUS_FILE, "w", encoding="utf-8") as f:
-            json.dump(statuses, f, indent=2, ensure_ascii=False)
+        addrs = resolve_cached(host, port)
     except Exception as e:
-        print("[ERROR] failed to save statuses.json:", e)
+        return probe_result(False, classify_error(e))
+    error = "error"
+    for fam, typ, proto, sa in addrs:
+        try:
+            with socket.socket(fam, typ, proto) as sock:
+                sock.settimeout(timeout)
+                t0 = time.perf_counter()
+                sock.connect(sa)
+                rtt_ms = (time.perf_counter() - t0) * 1000
+                return probe_result(True, rtt_ms=rtt_ms, tcp_info=read_tcp_info(sock))
+        except OSError as e:
+            error = classify_error(e)
+    return probe_result(False, error)
 
 def tcp_once(host, port, timeout=CONNECT_TIMEOUT):
+    return tcp_probe(host, port, timeout)["ok"]
+
+def attempt_timeout(timeout, attempt):
+    # С адаптивным таймаутом каждый следующий повтор ждёт вдвое дольше (как backoff RTO в TCP)
+    if not ADAPTIVE_TIMEOUT:
+        return timeout
+    return min(timeout * 2 ** attempt, max(timeout, ADAPTIVE_TIMEOUT_MAX))
+
+def hedging(retries):
+    return HEDGE_DELAY_SEC > 0 and retries > 1
+
+def tcp_probe_with_retries(host, port, retries=RETRIES_PER_CHECK, timeout=CONNECT_TIMEOUT):
+    if hedging(retries):
+        return tcp_probe_hedged(host, port, retries, timeout)
+    for i in range(max(1, retries)):
+        if i:
+            time.sleep(RETRY_DELAY_SEC)
+        res = tcp_probe(host, port, attempt_timeout(timeout, i))
+        if not should_retry(res):
+            break
+    return res
+
+def tcp_check_with_retries(host, port, retries=RETRIES_PER_CHECK):
+    return tcp_probe_with_retries(host, port, retries)["ok"]
+
+async def _open_connection_cached(host, port):
+    # -> (writer, время connect в мс)
+    last_exc = OSError(f"no addresses for {host}")
+    for _, _, _, sa in await resolve_cached_async(host, port):
+        try:
+            t0 = time.perf_counter()
+            _, writer = await asyncio.open_connection(sa[0], sa[1])
+            return writer, (time.perf_counter() - t0) * 1000
+        except OSError as e:
+            last_exc = e
+    raise last_exc
+
+async def tcp_probe_async(host, port, timeout=CONNECT_TIMEOUT):
     try:
-        with socket.create_connection((host, int(port)), timeout=timeout):
-            return True
+        writer, rtt_ms = await asyncio.wait_for(_open_connection_cached(host, port), timeout)
+    except Exception as e:
+        return probe_result(False, classify_error(e))
+    tcp_info = read_tcp_info(writer.get_extra_info("socket"))
+    writer.close()
+    try:
+        await writer.wait_closed()
     except Exception:
-        return False
+        pass
+    return probe_result(True, rtt_ms=rtt_ms, tcp_info=tcp_info)
 
-def tcp_check_with_retries(host, port, retries=RETRIES_PER_CHECK):
-    last = False
+async def tcp_once_async(host, port, timeout=CONNECT_TIMEOUT):
+    return (await tcp_probe_async(host, port, timeout))["ok"]
+
+async def tcp_probe_hedged_async(host, port, retries=RETRIES_PER_CHECK, timeout=CONNECT_TIMEOUT):
+    # Попытки стартуют с шагом HEDGE_DELAY_SEC (или сразу, если все предыдущие уже упали),
+    # все с одним таймаутом хоста; первый успех или fail-fast ошибка отменяет остальные.
+    # Худший случай — timeout + (retries - 1) * HEDGE_DELAY_SEC вместо retries * (timeout + delay);
+    # наращивание таймаута (attempt_timeout) — только у последовательных повторов
+    loop = asyncio.get_running_loop()
+    tasks, launched, res = set(), 0, None
+    next_launch = loop.time()
+    try:
+        while True:
+            if launched < retries and (not tasks or loop.time() >= next_launch):
+                tasks.add(asyncio.ensure_future(tcp_probe_async(host, port, timeout)))
+                launched += 1
+                next_launch = loop.time() + HEDGE_DELAY_SEC
+            if not tasks:
+                return res
+            wait = max(0.0, next_launch - loop.time()) if launched < retries else None
+            done, tasks = await asyncio.wait(tasks, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            for t in sorted(done, key=lambda t: not t.result()["ok"]):
+                res = t.result()
+                if not should_retry(res):
+                    return res
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def tcp_probe_with_retries_async(host, port, retries=RETRIES_PER_CHECK, timeout=CONNECT_TIMEOUT):
+    if hedging(retries):
+        return await tcp_probe_hedged_async(host, port, retries, timeout)
     for i in range(max(1, retries)):
-        ok = tcp_once(host, port)
-        if ok:
-            return True
-        last = ok
-        time.sleep(RETRY_DELAY_SEC)
-    return last
+        if i:
+            await asyncio.sleep(RETRY_DELAY_SEC)
+        res = await tcp_probe_async(host, port, attempt_timeout(timeout, i))
+        if not should_retry(res):
+            break
+    return res
+
+def probe_units(hosts):
+    # Индексы hosts по машинам (group); хост без group — отдельная единица
+    units, by_group = [], {}
+    for i, h in enumerate(hosts):
+        group = h.get("group")
+        if not group:
+            units.append([i])
+            continue
+        if group not in by_group:
+            by_group[group] = []
+            units.append(by_group[group])
+        by_group[group].append(i)
+    return units
+
+async def probe_hosts_async(hosts, concurrency=PROBE_CONCURRENCY):
+    # Семафор ограничивает число одновременно открытых соединений
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async def probe(h):
+        async with sem:
+            return await tcp_probe_with_retries_async(h["host"], int(h["port"]),
+                                                      timeout=h.get("timeout") or CONNECT_TIMEOUT)
+
+    async def probe_unit(unit):
+        # Пути одной машины проверяем параллельно, до первого успешного;
+        # оставшиеся отменяются и получают результат None
+        tasks = {asyncio.ensure_future(probe(hosts[i])): i for i in unit}
+        out = {}
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                out[tasks[t]] = t.result()
+            if pending and any(res["ok"] for res in out.values()):
+                for t in pending:
+                    t.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                break
+        return out
+
+    results = [None] * len(hosts)
+    for part in await asyncio.gather(*(probe_unit(u) for u in probe_units(hosts))):
+        for i, res in part.items():
+            results[i] = res
+    return results
+
+def probe_hosts_serial(hosts):
+    return [tcp_probe_with_retries(h["host"], h["port"], timeout=h.get("timeout") or CONNECT_TIMEOUT)
+            for h in hosts]
+
+def probe_hosts_threaded(hosts, workers=PROBE_WORKERS):
+    # Для синхронного кода: те же повторы, что в tcp_check_with_retries, но в N потоках.
+    # executor.map сохраняет порядок входного списка
+    if not hosts:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(hosts)))) as ex:
+        return list(ex.map(lambda h: tcp_probe_with_retries(
+            h["host"], int(h["port"]), timeout=h.get("timeout") or CONNECT_TIMEOUT), hosts))
+
+# connect_ex на неблокирующем сокете: "ещё идёт" (Linux/BSD и Windows)
+_CONNECT_IN_PROGRESS = {errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY,
+                        getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK)}
+
+def _connect_nonblocking(host, port, start=0):
+    # Адреса перебираем по очереди, как tcp_probe: немедленная ошибка — сразу следующий адрес.
+    # -> (sock, None, индекс адреса), если соединение ещё устанавливается; (None, результат, None),
+    # если всё решилось сразу; (None, None, None), если адресов начиная со start больше нет
+    try:
+        addrs = resolve_cached(host, port)
+    except Exception as e:
+        return None, probe_result(False, classify_error(e)), None
+    res = None
+    for n in range(start, len(addrs)):
+        family, type_, proto, addr = addrs[n]
+        try:
+            sock = socket.socket(family, type_, proto)
+        except OSError as e:
+            res = probe_result(False, classify_error(e))
+            continue
+        sock.setblocking(False)
+        t0 = time.perf_counter()
+        err = sock.connect_ex(addr)
+        if err in _CONNECT_IN_PROGRESS:
+            return sock, None, n
+        rtt_ms = (time.perf_counter() - t0) * 1000
+        tcp_info = read_tcp_info(sock) if err == 0 else None
+        sock.close()
+        res = probe_result(err == 0, classify_errno(err), rtt_ms=rtt_ms, tcp_info=tcp_info)
+        if err == 0:
+            break
+    return None, res, None
+
+def tcp_probe_batch(targets, timeout=CONNECT_TIMEOUT, batch_size=PROBE_BATCH_SIZE,
+                    attempts=1, hedge_delay=HEDGE_DELAY_SEC):
+    # Пакетный аналог tcp_probe: targets — список (host, port) или (host, port, timeout),
+    # результаты — в том же порядке. Одновременно держим не больше batch_size сокетов,
+    # у каждого свой дедлайн. attempts > 1 — хеджированные повторы: пока цель не ответила,
+    # каждые hedge_delay открывается ещё одна попытка, первый успех закрывает остальные
+    results = [None] * len(targets)
+    launched = [0] * len(targets)
+    pending = iter(range(len(targets)))
+    exhausted = False
+    ready = deque()              # хеджи, ждущие свободного места в batch_size
+    socks = defaultdict(set)     # idx -> сокеты его незавершённых попыток
+    inflight = {}                # sock -> (idx, время начала connect, индекс адреса)
+    timers = []                  # heap (when, seq, sock, idx): дедлайн сокета или старт хеджа
+                                 # (sock=None, вместо idx — (idx, число запусков на момент постановки))
+    seq = itertools.count()
+    remaining = len(targets)
+    sel = selectors.DefaultSelector()
+
+    def hedge_stale(i, count):
+        return results[i] is not None or launched[i] != count
+
+    def close(sock):
+        inflight.pop(sock)
+        sel.unregister(sock)
+        sock.close()
+
+    def conclude(i, res):
+        # Итог одной попытки; цель завершена при успехе, fail-fast ошибке или исчерпании попыток
+        nonlocal remaining
+        if results[i] is not None:
+            return
+        if should_retry(res) and socks[i]:
+            return
+        if should_retry(res) and launched[i] < attempts:
+            # Других попыток в полёте нет — следующую запускаем сразу, как и async-движок,
+            # не дожидаясь таймера хеджа
+            ready.append(i)
+            return
+        results[i] = res
+        remaining -= 1
+        for sock in socks.pop(i, ()):
+            close(sock)
+
+    def connect(i, start=0):
+        # -> (sock, None), если соединение устанавливается, иначе (None, результат или None)
+        t0 = time.perf_counter()
+        host, port = targets[i][:2]
+        sock, res, n = _connect_nonblocking(host, port, start)
+        if sock is None:
+            return None, res
+        inflight[sock] = (i, t0, n)
+        socks[i].add(sock)
+        sel.register(sock, selectors.EVENT_WRITE, i)
+        # Хеджированные попытки — с одним и тем же таймаутом цели: хвост ограничен одним таймаутом
+        sock_timeout = targets[i][2] if len(targets[i]) > 2 else timeout
+        heapq.heappush(timers, (time.monotonic() + sock_timeout, next(seq), sock, i))
+        return sock, None
+
+    def launch(i):
+        launched[i] += 1
+        if launched[i] < attempts:
+            heapq.heappush(timers, (time.monotonic() + hedge_delay, next(seq), None, (i, launched[i])))
+        sock, res = connect(i)
+        if sock is None:
+            conclude(i, res or probe_result(False, "dns"))
+
+    def finish(sock, ok, error=None):
+        i, t0, n = inflight[sock]
+        rtt_ms = (time.perf_counter() - t0) * 1000
+        tcp_info = read_tcp_info(sock) if ok else None
+        close(sock)
+        socks[i].discard(sock)
+        res = probe_result(ok, error, rtt_ms=rtt_ms, tcp_info=tcp_info)
+        if not ok:
+            # Адрес не ответил — в рамках той же попытки пробуем следующий адрес имени
+            nxt_sock, nxt = connect(i, n + 1)
+            if nxt_sock is not None:
+                return
+            res = nxt or res
+        conclude(i, res)
 
-def send_telegram(text):
-    if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
-        print("[INFO] Telegram not configured. Would send:", text)
-        return None
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    payload = {"chat_id": TELEGRAM_CHAT_ID, "text": text, "parse_mode": "HTML"}
     try:
-        r = requests.post(url, json=payload, timeout=10)
-        print("[TG] status:", r.status_code, "resp:", r.text)
+        while remaining:
+            while len(inflight) < max(1, batch_size) and (ready or not exhausted):
+                if ready:
+                    i = ready.popleft()
+                else:
+                    i = next(pending, None)
+                    if i is None:
+                        exhausted = True
+                        break
+                if results[i] is None and launched[i] < attempts:
+                    launch(i)
+            if not remaining:
+                break
+
+            # устаревшие таймеры: сокет уже закрыт, цель завершена или хедж уже запущен досрочно
+            while timers and (timers[0][2] not in inflight if timers[0][2] is not None
+                              else hedge_stale(*timers[0][3])):
+                heapq.heappop(timers)
+            if not timers:
+                continue
+            for key, _ in sel.select(max(0.0, timers[0][0] - time.monotonic())):
+                # сокет стал writable: connect завершился, итог — в SO_ERROR
+                if key.fileobj not in inflight:
+                    continue
+                err = key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                finish(key.fileobj, err == 0, classify_errno(err))
+
+            now = time.monotonic()
+            while timers and timers[0][0] <= now:
+                _, _, sock, i = heapq.heappop(timers)
+                if sock is None:
+                    if not hedge_stale(*i):
+                        ready.append(i[0])
+                elif sock in inflight:
+                    finish(sock, False, "timeout")
+    finally:
+        for sock in list(inflight):
+            close(sock)
+        sel.close()
+    return results
+
+def tcp_probe_hedged(host, port, retries=RETRIES_PER_CHECK, timeout=CONNECT_TIMEOUT):
+    # Синхронный вариант tcp_probe_hedged_async поверх того же цикла selectors
+    return tcp_probe_batch([(host, port, timeout)], batch_size=max(1, retries), attempts=max(1, retries))[0]
+
+def tcp_once_batch(targets, timeout=CONNECT_TIMEOUT, batch_size=PROBE_BATCH_SIZE):
+    return [res["ok"] for res in tcp_probe_batch(targets, timeout, batch_size)]
+
+def probe_hosts_batch(hosts, retries=RETRIES_PER_CHECK):
+    if hedging(retries):
+        return tcp_probe_batch([(h["host"], h["port"], h.get("timeout") or CONNECT_TIMEOUT) for h in hosts],
+                               attempts=retries)
+    # Повторы — только для тех, кто не ответил в предыдущем проходе
+    results = [None] * len(hosts)
+    todo = list(range(len(hosts)))
+    for attempt in range(max(1, retries)):
+        if attempt:
+            time.sleep(RETRY_DELAY_SEC)
+        batch = tcp_probe_batch([(hosts[i]["host"], hosts[i]["port"],
+                                  attempt_timeout(hosts[i].get("timeout") or CONNECT_TIMEOUT, attempt))
+                                 for i in todo])
+        for i, res in zip(todo, batch):
+            results[i] = res
+        todo = [i for i, res in zip(todo, batch) if should_retry(res)]
+        if not todo:
+            break
+    return results
+
+def probe_hosts(hosts):
+    # Результат на каждый хост — {"ok": bool, "error": класс ошибки или None}, в порядке hosts.yaml.
+    # None — путь машины не проверялся, потому что другой её путь уже ответил
+    if PROBE_ENGINE == "async":
+        return asyncio.run(probe_hosts_async(hosts))
+    engines = {"serial": probe_hosts_serial, "threads": probe_hosts_threaded, "batch": probe_hosts_batch}
+    if PROBE_ENGINE not in engines:
+        print(f"[WARN] unknown PROBE_ENGINE '{PROBE_ENGINE}', using async")
+        return asyncio.run(probe_hosts_async(hosts))
+    run = engines[PROBE_ENGINE]
+
+    # Синхронные движки проверяют машины в два прохода: сначала первый путь каждой,
+    # затем остальные пути тех машин, у которых первый не ответил
+    results = [None] * len(hosts)
+    units = probe_units(hosts)
+    first = [u[0] for u in units]
+    for i, res in zip(first, run([hosts[i] for i in first])):
+        results[i] = res
+    rest = [i for u in units if not results[u[0]]["ok"] for i in u[1:]]
+    for i, res in zip(rest, run([hosts[i] for i in rest])):
+        results[i] = res
+    return results
+
+_tg_queue = queue.Queue()
+_tg_worker = None
+_tg_session = None
+
+def telegram_session():
+    # Одна keep-alive сессия на процесс: без нового TCP+TLS рукопожатия на каждое сообщение.
+    # Используется только из потока отправки
+    global _tg_session
+    if _tg_session is None:
+        _tg_session = requests.Session()
+    return _tg_session
+
+def telegram_api(method, payload):
+    url = f"{TELEGRAM_API_BASE}/bot{TELEGRAM_BOT_TOKEN}/{method}"
+    try:
+        r = telegram_session().post(url, json=dict(payload, chat_id=TELEGRAM_CHAT_ID), timeout=TELEGRAM_TIMEOUT)
+        print(f"[TG] {method} status:", r.status_code, "resp:", r.text)
         return r
     except Exception as e:
-        print("[ERROR] Failed to send telegram:", e)
+        print(f"[ERROR] Failed to call telegram {method}:", e)
+        return None
+
+def send_telegram(text, parse_mode="HTML"):
+    if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
+        print("[INFO] Telegram not configured. Would send:", text)
         return None
+    payload = {"text": text}
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    return telegram_api("sendMessage", payload)
+
+# Outbox: {"pending": [{"id", "text", "created", "attempts", "next_attempt", ...}], "sent": [id, ...]}.
+# id — ключ идемпотентности события: повторно вычисленный переход (например, после падения
+# до сохранения состояния) второй раз не отправляется
+_outbox = None
+_outbox_lock = threading.Lock()
+_outbox_queued = set()       # id записей, уже стоящих в очереди отправителя
+_tg_pause_until = 0.0        # time.time(), до которого Telegram просил не слать (429)
+
+def outbox():
+    global _outbox
+    if _outbox is None:
+        data = {}
+        if os.path.exists(OUTBOX_FILE):
+            try:
+                with open(OUTBOX_FILE, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except Exception as e:
+                print(f"[WARN] failed to load {OUTBOX_FILE}:", e)
+        _outbox = {"pending": data.get("pending", []), "sent": data.get("sent", [])}
+    return _outbox
+
+def save_outbox():
+    with _outbox_lock:
+        box = outbox()
+        box["sent"] = box["sent"][-OUTBOX_SENT_KEEP:]
+        if not box["pending"] and not box["sent"] and not os.path.exists(OUTBOX_FILE):
+            return
+        try:
+            write_json_atomic(OUTBOX_FILE, box)
+        except Exception as e:
+            print(f"[ERROR] failed to save {OUTBOX_FILE}:", e)
+
+def split_message(text, limit=TELEGRAM_MAX_MESSAGE - DIGEST_HEADER_RESERVE):
+    # Режем по строкам, слишком длинную строку — по символам
+    parts, cur = [], ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if cur:
+                parts.append(cur)
+                cur = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        if cur and len(cur) + 1 + len(line) > limit:
+            parts.append(cur)
+            cur = line
+        else:
+            cur = f"{cur}\n{line}" if cur else line
+    if cur or not parts:
+        parts.append(cur)
+    return parts
+
+def outbox_add(key, text):
+    parts = split_message(text)
+    with _outbox_lock:
+        box = outbox()
+        # Длинное сообщение хранится частями key#1, key#2, ... — их тоже считаем за key
+        ids = box["sent"] + [e["id"] for e in box["pending"]]
+        if any(ident == key or ident.startswith(key + "#") for ident in ids):
+            print(f"[INFO] Notification {key} already queued or sent, skipping")
+            return
+        for n, part in enumerate(parts):
+            # next_attempt новой записи — момент её появления (от него отсчитывается DIGEST_WINDOW_SEC)
+            box["pending"].append({"id": key if len(parts) == 1 else f"{key}#{n + 1}", "text": part,
+                                   "created": now_iso(), "attempts": 0, "next_attempt": time.time()})
+
+def digest_batches(entries, limit=TELEGRAM_MAX_MESSAGE):
+    # Записи подряд, пока сводка с заголовком влезает в одно сообщение
+    batches, cur, size = [], [], DIGEST_HEADER_RESERVE
+    for entry in entries:
+        add = len(entry["text"]) + 2
+        if cur and size + add > limit:
+            batches.append(cur)
+            cur, size = [], DIGEST_HEADER_RESERVE
+        cur.append(entry)
+        size += add
+    if cur:
+        batches.append(cur)
+    return batches
+
+def digest_text(batch):
+    if len(batch) == 1:
+        return batch[0]["text"]
+    return f"📋 <b>{len(batch)} events</b>\n\n" + "\n\n".join(e["text"] for e in batch)
+
+def retry_delay(entry, r):
+    # Пауза до следующей попытки; 429 -> parameters.retry_after из ответа Telegram
+    global _tg_pause_until
+    if r is not None and r.status_code == 429:
+        try:
+            delay = float(r.json()["parameters"]["retry_after"])
+        except Exception:
+            delay = OUTBOX_BACKOFF_SEC
+        _tg_pause_until = time.time() + delay
+        return delay
+    if r is not None and r.status_code == 400 and not entry.get("plain"):
+        # Telegram не разобрал HTML — повторяем тем же текстом без parse_mode
+        entry["plain"] = True
+        return 0.0
+    return min(OUTBOX_BACKOFF_SEC * 2 ** entry["attempts"], OUTBOX_BACKOFF_MAX_SEC)
+
+def deliver(batch):
+    text = digest_text(batch)
+    if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
+        r = send_telegram(text)
+        ok = True
+    else:
+        pause = _tg_pause_until - time.time()
+        if pause > 0:
+            time.sleep(pause)
+        plain = any(e.get("plain") for e in batch)
+        r = send_telegram(text, None if plain else "HTML")
+        ok = r is not None and r.ok
+    ids = {e["id"] for e in batch}
+    with _outbox_lock:
+        box = outbox()
+        if ok:
+            box["pending"] = [e for e in box["pending"] if e["id"] not in ids]
+            box["sent"].extend(e["id"] for e in batch)
+        else:
+            error = f"HTTP {r.status_code}" if r is not None else "network"
+            for entry in batch:
+                delay = retry_delay(entry, r)
+                entry["attempts"] += 1
+                entry["next_attempt"] = time.time() + delay
+                entry["last_error"] = error
+            print(f"[WARN] {len(batch)} notification(s) failed ({error}), retry in {delay:.0f}s")
+        _outbox_queued.difference_update(ids)
+
+def _telegram_sender():
+    while True:
+        job = _tg_queue.get()
+        try:
+            if callable(job):
+                job()
+            else:
+                deliver(job)
+        except Exception as e:
+            print("[ERROR] telegram sender:", e)
+            if not callable(job):
+                with _outbox_lock:
+                    _outbox_queued.difference_update(e["id"] for e in job)
+        finally:
+            _tg_queue.task_done()
+
+def enqueue_telegram(batch):
+    # Проверки не ждут Telegram: пачка записей outbox (или функция, как у табло) уходит в очередь,
+    # выполняет фоновый поток
+    global _tg_worker
+    if _tg_worker is None:
+        _tg_worker = threading.Thread(target=_telegram_sender, name="telegram-sender", daemon=True)
+        _tg_worker.start()
+    _tg_queue.put(batch)
+
+def flush_outbox(window=0.0):
+    # Всё, чему подошло время, — в очередь отправителя сводками, одним проходом за цикл.
+    # Новые записи (attempts == 0) ждут, пока самой старой из них не исполнится window
+    now = time.time()
+    with _outbox_lock:
+        due = [e for e in outbox()["pending"] if e["next_attempt"] <= now and e["id"] not in _outbox_queued]
+        fresh = [e for e in due if not e["attempts"]]
+        if fresh and min(e["next_attempt"] for e in fresh) + window > now:
+            due = [e for e in due if e["attempts"]]
+        _outbox_queued.update(e["id"] for e in due)
+    for batch in digest_batches(due):
+        enqueue_telegram(batch)
+    return len(due)
+
+def drain_telegram(timeout=TELEGRAM_DRAIN_SEC):
+    # Ждём, пока очередь опустеет, но не дольше timeout -> True, если очередь пуста
+    deadline = time.monotonic() + timeout
+    with _tg_queue.all_tasks_done:
+        while _tg_queue.unfinished_tasks:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return False
+            _tg_queue.all_tasks_done.wait(left)
+    return True
+
+def deliver_outbox(timeout=TELEGRAM_DRAIN_SEC):
+    # Конец прогона: отправляем outbox, повторяя то, чья пауза укладывается в timeout.
+    # Не успевшее остаётся в OUTBOX_FILE до следующего запуска
+    deadline = time.monotonic() + timeout
+    while True:
+        flush_outbox()
+        drained = drain_telegram(max(0.0, deadline - time.monotonic()))
+        with _outbox_lock:
+            pending = list(outbox()["pending"])
+        if not pending:
+            return True
+        wait = min(e["next_attempt"] for e in pending) - time.time()
+        if not drained or time.monotonic() + wait >= deadline:
+            print(f"[WARN] {len(pending)} notification(s) kept in {OUTBOX_FILE} for the next run")
+            return False
+        time.sleep(max(0.0, wait))
+
+def format_since(iso_ts):
+    # Абсолютная метка вместо "лежит 5м 12с": текст табло не меняется, пока не меняется статус
+    try:
+        return datetime.fromisoformat(iso_ts).astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
+    except Exception:
+        return "?"
+
+def render_board(statuses):
+    # Машины (группы путей) и одиночные хосты; пути машин отдельно не показываем
+    icons = {"offline": "🔴", "degraded": "🟡", "online": "🟢"}
+    order = {"offline": 0, "degraded": 1, "online": 2}
+    recs = [rec for key, rec in statuses.items()
+            if not is_meta_key(key) and ("paths" in rec or not rec.get("group"))]
+    recs.sort(key=lambda rec: (order.get(rec.get("combined"), 3), rec.get("name") or ""))
+    counts = {state: sum(1 for rec in recs if rec.get("combined") == state) for state in order}
+    lines = [f"📊 <b>Status</b>: {counts['online']} online, {counts['degraded']} degraded, "
+             f"{counts['offline']} offline"]
+    for rec in recs:
+        state = rec.get("combined")
+        line = f"{icons.get(state, '⚪')} {rec.get('name')}"
+        if state == "offline":
+            since = rec.get("offline_since")
+            line += f" — since <code>{format_since(since)}</code>" if since else " — offline"
+            if rec.get("suppressed_by"):
+                line += f" (via {rec['suppressed_by']})"
+        lines.append(line)
+    text = "\n".join(lines)
+    if len(text) > TELEGRAM_MAX_MESSAGE:
+        text = text[:text.rfind("\n", 0, TELEGRAM_MAX_MESSAGE - 2)] + "\n…"
+    return text
+
+def _push_board(board, text, digest):
+    r = None
+    if board.get("message_id"):
+        r = telegram_api("editMessageText", {"message_id": board["message_id"], "text": text,
+                                             "parse_mode": "HTML"})
+        if r is not None and r.status_code == 400 and "not modified" in r.text:
+            board["hash"] = digest
+            return
+    if board.get("message_id") is None or (r is not None and r.status_code == 400):
+        # Табло ещё нет или его удалили — публикуем заново и закрепляем без звука
+        r = telegram_api("sendMessage", {"text": text, "parse_mode": "HTML", "disable_notification": True})
+        if r is not None and r.ok:
+            board["message_id"] = r.json()["result"]["message_id"]
+            telegram_api("pinChatMessage", {"message_id": board["message_id"], "disable_notification": True})
+    if r is not None and r.ok:
+        board["hash"] = digest
+
+def update_board(statuses):
+    # Хэш сохраняется только после успешной правки — при ошибке повторим в следующем цикле
+    if not STATUS_BOARD:
+        return
+    text = render_board(statuses)
+    digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+    board = statuses.setdefault(BOARD_KEY, {"message_id": None, "hash": None})
+    if board.get("hash") == digest:
+        return
+    if DRY_RUN or not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
+        print("[INFO] Status board would be:\n" + text)
+        board["hash"] = digest
+        return
+    enqueue_telegram(lambda: _push_board(board, text, digest))
 
 def format_duration_since(iso_ts):
     if not iso_ts:
@@ -132,99 +1258,644 @@ def format_duration_since(iso_ts):
     except Exception:
         return "?"
 
-def main():
-    hosts = load_hosts()
-    statuses = load_statuses()
+class ProbeHistory:
+    # Кольцевые буферы последних `size` проверок хоста: бит на успех (bytearray)
+    # и float32 на задержку connect в мс (array "f", NaN — проверка неудачна).
+    # Память фиксирована: size/8 + size*4 байт, сколько бы ни работал daemon
+    __slots__ = ("size", "count", "pos", "ok", "rtt")
+
+    def __init__(self, size):
+        self.size = max(1, int(size))
+        self.count = 0
+        self.pos = 0
+        self.ok = bytearray((self.size + 7) // 8)
+        self.rtt = array("f", [math.nan]) * self.size
+
+    def push(self, ok, rtt_ms=None):
+        i = self.pos
+        byte, bit = divmod(i, 8)
+        if ok:
+            self.ok[byte] |= 1 << bit
+        else:
+            self.ok[byte] &= ~(1 << bit) & 0xFF
+        self.rtt[i] = math.nan if rtt_ms is None else rtt_ms
+        self.pos = (i + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def entries(self):
+        # (ok, rtt_ms) от старых к новым
+        start = (self.pos - self.count) % self.size
+        for j in range(self.count):
+            i = (start + j) % self.size
+            rtt = self.rtt[i]
+            yield bool(self.ok[i // 8] >> (i % 8) & 1), None if math.isnan(rtt) else rtt
+
+    def success_ratio(self):
+        if not self.count:
+            return None
+        return sum(1 for ok, _ in self.entries() if ok) / self.count
+
+    def encode(self):
+        rtt = array("f", self.rtt)
+        if sys.byteorder != "little":
+            rtt.byteswap()
+        return {"size": self.size, "count": self.count, "pos": self.pos,
+                "ok": base64.b64encode(bytes(self.ok)).decode("ascii"),
+                "rtt": base64.b64encode(rtt.tobytes()).decode("ascii")}
+
+    @classmethod
+    def decode(cls, data, size):
+        stored = cls(data["size"])
+        stored.ok[:] = base64.b64decode(data["ok"])
+        stored.rtt = array("f")
+        stored.rtt.frombytes(base64.b64decode(data["rtt"]))
+        if sys.byteorder != "little":
+            stored.rtt.byteswap()
+        if len(stored.ok) != (stored.size + 7) // 8 or len(stored.rtt) != stored.size:
+            raise ValueError("history buffer size mismatch")
+        stored.count, stored.pos = int(data["count"]), int(data["pos"])
+        if stored.size == size:
+            return stored
+        # HISTORY_SIZE поменялся — переливаем последние записи в буфер нового размера
+        hist = cls(size)
+        for ok, rtt in stored.entries():
+            hist.push(ok, rtt)
+        return hist
+
+_histories = {}   # key -> ProbeHistory
+
+def history_for(key, rec):
+    hist = _histories.get(key)
+    if hist is None:
+        hist = ProbeHistory(HISTORY_SIZE)
+        if rec.get("history"):
+            try:
+                hist = ProbeHistory.decode(rec["history"], HISTORY_SIZE)
+            except Exception as e:
+                print(f"[WARN] {key}: dropping unreadable probe history:", e)
+        _histories[key] = hist
+    return hist
+
+# Границы бакетов гистограммы задержек: от LATENCY_MIN_MS с шагом x(1 + 1/16), до ~60 с
+LATENCY_MIN_MS = 0.1
+LATENCY_GROWTH = 1 + 1 / 16
+LATENCY_BUCKETS = int(math.log(60000 / LATENCY_MIN_MS) / math.log(LATENCY_GROWTH)) + 2
+
+class LatencyHistogram:
+    # Гистограмма задержек connect в стиле HDR: логарифмические бакеты с погрешностью ~6%,
+    # p50/p95/p99 — проходом по 200+ счётчикам. Когда набирается LATENCY_WINDOW замеров,
+    # счётчики делятся пополам — старые замеры постепенно забываются
+    __slots__ = ("counts", "total")
+
+    def __init__(self):
+        self.counts = array("I", [0]) * LATENCY_BUCKETS
+        self.total = 0
+
+    @staticmethod
+    def bucket(ms):
+        if ms <= LATENCY_MIN_MS:
+            return 0
+        return min(LATENCY_BUCKETS - 1, int(math.log(ms / LATENCY_MIN_MS) / math.log(LATENCY_GROWTH)) + 1)
+
+    @staticmethod
+    def upper_bound(i):
+        return LATENCY_MIN_MS * LATENCY_GROWTH ** i
+
+    def record(self, ms):
+        self.counts[self.bucket(ms)] += 1
+        self.total += 1
+        if self.total >= LATENCY_WINDOW:
+            for i, c in enumerate(self.counts):
+                self.counts[i] = c // 2
+            self.total = sum(self.counts)
+
+    def percentile(self, p):
+        if not self.total:
+            return None
+        target = max(1, math.ceil(self.total * p / 100))
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target:
+                return round(self.upper_bound(i), 2)
+        return None
+
+    def summary(self):
+        return {"p50": self.percentile(50), "p95": self.percentile(95), "p99": self.percentile(99)}
+
+    def encode(self):
+        # Разреженно: только непустые бакеты
+        return dict(self.summary(), buckets=[[i, c] for i, c in enumerate(self.counts) if c])
+
+    @classmethod
+    def decode(cls, data):
+        hist = cls()
+        for i, c in data.get("buckets") or []:
+            if 0 <= i < LATENCY_BUCKETS:
+                hist.counts[i] = c
+        hist.total = sum(hist.counts)
+        return hist
+
+_latencies = {}   # key -> LatencyHistogram
+
+def latency_for(key, rec):
+    hist = _latencies.get(key)
+    if hist is None:
+        hist = LatencyHistogram()
+        if rec.get("latency"):
+            try:
+                hist = LatencyHistogram.decode(rec["latency"])
+            except Exception as e:
+                print(f"[WARN] {key}: dropping unreadable latency histogram:", e)
+        _latencies[key] = hist
+    return hist
+
+def update_rto(rec, res):
+    # Оценка как у RTO в TCP (RFC 6298): SRTT/RTTVAR по времени connect,
+    # таймаут = SRTT + 4*RTTVAR в пределах [ADAPTIVE_TIMEOUT_MIN, ADAPTIVE_TIMEOUT_MAX].
+    # После таймаута — удваиваем (RFC 6298 5.5), но не выше CONNECT_TIMEOUT: лежащий хост
+    # не должен стоить дороже, чем с глобальным таймаутом
+    rtt_ms = res.get("rtt_ms")
+    if rtt_ms is None:
+        if res.get("error") == "timeout" and rec.get("timeout_s"):
+            cap = max(CONNECT_TIMEOUT, ADAPTIVE_TIMEOUT_MIN)
+            rec["timeout_s"] = round(min(rec["timeout_s"] * 2, max(cap, rec["timeout_s"])), 3)
+        return
+    srtt, rttvar = rec.get("srtt_ms"), rec.get("rttvar_ms")
+    if srtt is None or rttvar is None:
+        srtt, rttvar = rtt_ms, rtt_ms / 2
+    else:
+        rttvar = 0.75 * rttvar + 0.25 * abs(srtt - rtt_ms)
+        srtt = 0.875 * srtt + 0.125 * rtt_ms
+    rec["srtt_ms"] = round(srtt, 3)
+    rec["rttvar_ms"] = round(rttvar, 3)
+    rto = (srtt + 4 * rttvar) / 1000
+    rec["timeout_s"] = round(min(max(rto, ADAPTIVE_TIMEOUT_MIN), ADAPTIVE_TIMEOUT_MAX), 3)
+
+def with_timeouts(statuses, hosts):
+    # Копии записей hosts с таймаутом connect для каждого: адаптивным, если он уже посчитан
+    if not ADAPTIVE_TIMEOUT:
+        return hosts
+    return [dict(h, timeout=(statuses.get(host_key(h)) or {}).get("timeout_s") or CONNECT_TIMEOUT)
+            for h in hosts]
 
+def update_degraded(rec, lat):
+    # degraded — между online и offline: хост отвечает, но p95 задержки выше DEGRADED_RTT_MS
+    if rec.get("combined") not in ("online", "degraded"):
+        return
+    p95 = lat.percentile(95)
+    # DEGRADED_RTT_MS=0 (порог выключили) — оставшийся degraded возвращаем в online
+    degraded = DEGRADED_RTT_MS > 0 and p95 is not None and p95 > DEGRADED_RTT_MS
+    state = "degraded" if degraded else "online"
+    if state != rec["combined"]:
+        print(f"[WARN] {rec['name']} {rec['combined']} -> {state} (p95={p95}ms, threshold {DEGRADED_RTT_MS}ms)")
+        rec["combined"] = state
+
+def notify(msg, key=None):
+    # key — ключ идемпотентности; без него — хэш текста
+    if DRY_RUN:
+        print("[DRY_RUN] would send:", msg)
+    else:
+        outbox_add(key or "msg:" + hashlib.sha1(msg.encode("utf-8")).hexdigest()[:16], msg)
+
+def threshold_reached(rec, counter, count, after_sec):
+    # Порог в проверках подряд или в секундах от первой проверки текущей серии до последней
+    if after_sec is None:
+        return (rec.get(counter) or 0) >= count
+    try:
+        streak = datetime.fromisoformat(rec["last_check"]) - datetime.fromisoformat(rec["streak_since"])
+    except (KeyError, TypeError, ValueError):
+        return False
+    return streak.total_seconds() >= after_sec
+
+def apply_probe(rec, ok):
+    # Hysteresis: combined меняется только после FAIL_THRESHOLD / RECOVERY_THRESHOLD подряд.
+    # Возвращает событие {"rec", "kind": "offline"|"online", ...} при смене состояния, иначе None
+    prev_combined = rec.get("combined", "")
+    ts = now_iso()
+    counter = "consec_success" if ok else "consec_fails"
+    if ok:
+        rec["consec_success"] = (rec.get("consec_success") or 0) + 1
+        rec["consec_fails"] = 0
+        rec.pop("fail_since", None)
+    else:
+        rec["consec_fails"] = (rec.get("consec_fails") or 0) + 1
+        rec["consec_success"] = 0
+        # Начало сбоя — в volatile fail_since; в durable offline_since оно попадает только
+        # при переходе в OFFLINE, чтобы короткий сбой не менял закоммиченное состояние
+        if not rec.get("fail_since"):
+            rec["fail_since"] = ts
+        if prev_combined == "offline" and not rec.get("offline_since"):
+            rec["offline_since"] = rec["fail_since"]
+    # Начало текущей серии одинаковых результатов — для порогов-длительностей
+    if rec[counter] == 1 or not rec.get("streak_since"):
+        rec["streak_since"] = ts
+    rec["last_check"] = ts
+
+    # Переход в OFFLINE (если ранее не offline, и достигнут FAIL_THRESHOLD)
+    if not ok and prev_combined != "offline":
+        if threshold_reached(rec, "consec_fails", FAIL_THRESHOLD, FAIL_AFTER_SEC):
+            rec["combined"] = "offline"
+            rec["offline_since"] = rec["fail_since"]
+            return {"rec": rec, "kind": "offline"}
+        return None
+
+    # Переход в ONLINE (если ранее offline и достигнут RECOVERY_THRESHOLD) — запоминаем длительность простоя
+    if ok and prev_combined == "offline":
+        if threshold_reached(rec, "consec_success", RECOVERY_THRESHOLD, RECOVER_AFTER_SEC):
+            downtime = format_duration_since(rec.get("offline_since"))
+            rec["combined"] = "online"
+            rec["offline_since"] = None
+            return {"rec": rec, "kind": "online", "downtime": downtime}
+        return None
+
+    # Короткий сбой, не дошедший до OFFLINE, простоем не считаем.
+    # degraded не трогаем — его по задержкам ставит и снимает update_degraded
+    if ok:
+        if rec.get("combined") != "degraded":
+            rec["combined"] = "online"
+        rec["offline_since"] = None
+    return None
+
+def format_event(ev):
+    rec = ev["rec"]
+    if "paths" in rec:
+        where = "Paths: " + ", ".join(f"<code>{p}</code>" for p in rec["paths"])
+    else:
+        where = f"Host: <code>{rec['host']}:{rec['port']}</code>"
+    if ev["kind"] == "offline":
+        return (f"⚠️ <b>{rec['name']} OFFLINE</b>\n"
+                f"{where}\n"
+                f"Time: <code>{rec['offline_since']}</code>\n"
+                f"Consecutive fails: {rec['consec_fails']}")
+    return (f"🟢 <b>{rec['name']} ONLINE</b>\n"
+            f"{where}\n"
+            f"Time: <code>{rec['last_check']}</code>\n"
+            f"Was offline: {ev.get('downtime', '?')}")
+
+def event_key(ev):
+    # Переход однозначно задаётся записью, направлением и моментом: offline_since для OFFLINE,
+    # last_check для ONLINE
+    rec = ev["rec"]
+    ident = f"{rec['host']}:{rec['port']}" if "host" in rec else group_key(rec.get("group") or rec["name"])
+    stamp = rec.get("offline_since") if ev["kind"] == "offline" else rec.get("last_check")
+    return f"{ev['kind']}:{ident}:{stamp}"
+
+def is_meta_key(key):
+    # Служебные записи в statuses (состояние релеев и т.п.), не хосты
+    return key.startswith("__")
+
+def host_key(h):
+    return f"{h['host']}:{h['port']}"
+
+def group_key(group):
+    return f"group:{group}"
+
+def update_machines(statuses, hosts, results):
+    # Hysteresis по машинам: машина online, если в этом цикле ответил хотя бы один её путь.
+    # Возвращает события машин
+    paths = {}
+    for h, res in zip(hosts, results):
+        if h.get("group"):
+            paths.setdefault(h["group"], []).append((h, res))
+    events = []
+    for group, items in paths.items():
+        ok = any(res is not None and res["ok"] for _, res in items)
+        key = group_key(group)
+        rec = statuses.get(key, {
+            "name": group,
+            "group": group,
+            "combined": "online" if ok else "offline",
+            "consec_fails": 0,
+            "consec_success": 0,
+            "offline_since": None,
+            "last_check": None
+        })
+        rec["paths"] = [host_key(h) for h, _ in items]
+        ev = apply_probe(rec, ok)
+        statuses[key] = rec
+        if ev:
+            events.append(ev)
+        print(f"[INFO] Machine {group} -> {rec['combined']} (fails={rec.get('consec_fails')} succ={rec.get('consec_success')})")
+    return events
+
+def correlate_machines(statuses, path_events, machine_events):
+    # Пока машина лежит целиком, алерты по её отдельным путям не шлём — хватает алерта машины
+    changed = {ev["rec"]["group"] for ev in machine_events}
+    out = []
+    for ev in path_events:
+        rec = ev["rec"]
+        group = rec.get("group")
+        if not group:
+            out.append(ev)
+            continue
+        key = group_key(group)
+        if ev["kind"] == "offline" and (group in changed or statuses[key].get("combined") == "offline"):
+            rec["suppressed_by"] = key
+            continue
+        if ev["kind"] == "online" and rec.get("suppressed_by") == key:
+            rec.pop("suppressed_by")
+            continue
+        out.append(ev)
+    return out
+
+def failing_relays(statuses):
+    # Релей (hostname, общий для нескольких целей) считается упавшим, если за ним не меньше
+    # RELAY_MIN_TARGETS целей и у доли >= RELAY_FAIL_RATIO последняя проверка неудачна.
+    # Считаем по записям, а не по одному циклу — в daemon-режиме цели релея проверяются в разное время.
+    # Пути машин, пропущенные в последней проверке (ответил другой путь), не считаются ни в total, ни в failed
+    out = {}
+    for relay, recs in relay_targets(statuses).items():
+        failed = [rec for rec in recs if rec.get("consec_fails")]
+        if len(recs) >= max(2, RELAY_MIN_TARGETS) and len(failed) >= len(recs) * RELAY_FAIL_RATIO:
+            out[relay] = (len(recs), failed)
+    return out
+
+def relay_targets(statuses):
+    # hostname -> записи целей за ним
+    targets = {}
+    for key, rec in statuses.items():
+        if is_meta_key(key) or "host" not in rec or rec.get("skipped"):
+            continue
+        targets.setdefault(rec["host"], []).append(rec)
+    return targets
+
+def relay_recovered(recs):
+    # Как и у хостов, восстановление — только после RECOVERY_THRESHOLD: цель, ещё не набравшая
+    # порог успехов, считается лежащей
+    pending = [rec for rec in recs
+               if not threshold_reached(rec, "consec_success", RECOVERY_THRESHOLD, RECOVER_AFTER_SEC)]
+    return not recs or len(pending) < len(recs) * RELAY_FAIL_RATIO
+
+def correlate_relays(statuses, events):
+    # Одно "relay down" вместо пачки OFFLINE по всем хостам за релеем.
+    # Возвращает события, о которых нужно уведомить по-хостово
+    relays = statuses.setdefault(RELAYS_KEY, {})
+    failing = failing_relays(statuses)
+    out = []
+    for ev in events:
+        rec = ev["rec"]
+        relay = rec["host"]
+        if ev["kind"] == "offline" and relay in failing:
+            rec["suppressed_by"] = relay
+            if relay not in relays:
+                total, failed = failing[relay]
+                # Начало сбоя — самая ранняя первая неудача среди упавших целей, как offline_since у хостов
+                since = min((r.get("offline_since") or r.get("fail_since") or now_iso() for r in failed))
+                relays[relay] = {"since": since}
+                notify(f"🔴 <b>Relay {relay} DOWN</b>\n"
+                       f"Failing targets: {len(failed)}/{total}\n"
+                       f"Time: <code>{relays[relay]['since']}</code>",
+                       key=f"relay-down:{relay}:{relays[relay]['since']}")
+            continue
+        # ONLINE для хоста, чей OFFLINE был поглощён релеем — покрывается сообщением о восстановлении релея
+        if rec.pop("suppressed_by", None) and ev["kind"] == "online":
+            continue
+        out.append(ev)
+
+    targets = relay_targets(statuses)
+    for relay in [r for r in relays if r not in failing and relay_recovered(targets.get(r, []))]:
+        info = relays.pop(relay)
+        # Релей поднялся — для хостов, которые всё ещё лежат, возвращаемся к обычным алертам
+        still_down = [rec for k, rec in statuses.items()
+                      if not is_meta_key(k) and rec.get("suppressed_by") == relay
+                      and rec.get("combined") == "offline" and rec.get("consec_fails")]
+        msg = (f"🟢 <b>Relay {relay} recovered</b>\n"
+               f"Was down: {format_duration_since(info.get('since'))}")
+        if still_down:
+            msg += f"\nStill offline: {', '.join(rec['name'] for rec in still_down)}"
+        notify(msg, key=f"relay-up:{relay}:{info.get('since')}")
+        for rec in still_down:
+            rec.pop("suppressed_by", None)
+            out.append({"rec": rec, "kind": "offline"})
+    if not relays:
+        del statuses[RELAYS_KEY]
+    return out
+
+def process_results(statuses, hosts, results):
+    # Hysteresis и уведомления по результатам проверки hosts
+    events = []
     # Обрабатывать все хосты из hosts.yaml — это даёт корректные имена
-    for h in hosts:
+    for h, res in zip(hosts, results):
         name = h["name"]
         host = h["host"]
         port = int(h["port"])
         key = f"{host}:{port}"
 
-        prev = statuses.get(key, {})
-        prev_combined = prev.get("combined", "")
-        prev_offline_since = prev.get("offline_since")
-
-        # Текущая проверка TCP с повторами
-        is_online = tcp_check_with_retries(host, port, retries=RETRIES_PER_CHECK)
-        temp_combined = "online" if is_online else "offline"
+        # Путь машины не проверялся (другой путь ответил первым) — новых данных нет
+        if res is None:
+            print(f"[INFO] {name} {key} -> skipped (machine reachable via another path)")
+            if key in statuses:
+                # счётчики записи устарели — для корреляции по релею она не в счёт
+                statuses[key]["skipped"] = True
+            continue
 
         # Инициализация записи, если нет
         rec = statuses.get(key, {
             "name": name,
             "host": host,
             "port": port,
-            "combined": temp_combined,
+            "combined": "online" if res["ok"] else "offline",
             "consec_fails": 0,
             "consec_success": 0,
             "offline_since": None,
-            "last_check": None
+            "last_check": None,
+            "last_error": None
         })
 
         # Если имя в hosts.yaml поменялось — обновим его в записи
         if rec.get("name") != name:
             print(f"[INFO] Update stored name for {key}: '{rec.get('name')}' -> '{name}'")
             rec["name"] = name
+        rec["group"] = h.get("group")
+        rec.pop("skipped", None)
 
-        # Обновляем счётчики и offline_since
-        if temp_combined == "online":
-            rec["consec_success"] = (rec.get("consec_success") or 0) + 1
-            rec["consec_fails"] = 0
-        else:
-            rec["consec_fails"] = (rec.get("consec_fails") or 0) + 1
-            rec["consec_success"] = 0
-            if not rec.get("offline_since"):
-                rec["offline_since"] = now_iso()
-
-        rec["combined"] = temp_combined
-        rec["last_check"] = now_iso()
+        ev = apply_probe(rec, res["ok"])
+        rec["last_error"] = res["error"]   # класс ошибки последней проверки — для диагностики
         statuses[key] = rec
-
-        # --- Логика уведомлений: отправлять только при переходе состояния после достижения порога ---
-        # Переход в OFFLINE (если ранее не offline, и достигнут FAIL_THRESHOLD)
-        if temp_combined == "offline" and prev_combined != "offline":
-            if rec["consec_fails"] >= FAIL_THRESHOLD:
-                msg = (f"⚠️ <b>{rec['name']} OFFLINE</b>\n"
-                       f"Host: <code>{rec['host']}:{rec['port']}</code>\n"
-                       f"Time: <code>{rec['offline_since']}</code>\n"
-                       f"Consecutive fails: {rec['consec_fails']}")
-                if DRY_RUN:
-                    print("[DRY_RUN] would send:", msg)
-                else:
-                    send_telegram(msg)
-
-        # Переход в ONLINE (если ранее offline и достигнут RECOVERY_THRESHOLD) — при этом указываем длительность простоя
-        if temp_combined == "online" and prev_combined == "offline":
-            if rec["consec_success"] >= RECOVERY_THRESHOLD:
-                downtime = format_duration_since(rec.get("offline_since"))
-                msg = (f"🟢 <b>{rec['name']} ONLINE</b>\n"
-                       f"Host: <code>{rec['host']}:{rec['port']}</code>\n"
-                       f"Time: <code>{rec['last_check']}</code>\n"
-                       f"Was offline: {downtime}")
-                if DRY_RUN:
-                    print("[DRY_RUN] would send:", msg)
-                else:
-                    send_telegram(msg)
-                # очистим offline_since
-                rec["offline_since"] = None
+        if ev:
+            events.append(ev)
+        hist = history_for(key, rec)
+        hist.push(res["ok"], res.get("rtt_ms"))
+        lat = latency_for(key, rec)
+        if res.get("rtt_ms") is not None:
+            lat.record(res["rtt_ms"])
+        rec["rtt_ms"] = res.get("rtt_ms")
+        update_rto(rec, res)
+        update_degraded(rec, lat)
+        # SYN пришлось переотправлять — путь теряет пакеты, хотя хост и ответил
+        rec["tcp_info"] = res.get("tcp_info")
+        rec["lossy"] = bool(res.get("tcp_info") and res["tcp_info"]["total_retrans"] > 0)
 
         # Печать статуса в лог
-        print(f"[INFO] {rec['name']} {key} -> {rec['combined']} (fails={rec.get('consec_fails')} succ={rec.get('consec_success')})")
+        err = f" error={res['error']}" if res["error"] else ""
+        up = f" up={hist.success_ratio():.0%}/{hist.count}"
+        rtt = ""
+        if lat.total:
+            q = lat.summary()
+            # у неудачной проверки своего rtt нет — только перцентили истории
+            rtt = f" rtt={res['rtt_ms']}ms" if res.get("rtt_ms") is not None else ""
+            rtt += f" p50/p95/p99={q['p50']}/{q['p95']}/{q['p99']}ms"
+        if res.get("tcp_info"):
+            ti = res["tcp_info"]
+            rtt += f" krtt={ti['rtt_us'] / 1000:.1f}±{ti['rttvar_us'] / 1000:.1f}ms"
+        lossy = f" LOSSY(retrans={res['tcp_info']['total_retrans']})" if rec["lossy"] else ""
+        print(f"[INFO] {rec['name']} {key} -> {rec['combined']} (fails={rec.get('consec_fails')} succ={rec.get('consec_success')}){up}{rtt}{lossy}{err}")
+
+    machine_events = update_machines(statuses, hosts, results)
 
+    # --- Логика уведомлений: только при переходе состояния после достижения порога ---
+    events = correlate_machines(statuses, events, machine_events)
+    for ev in correlate_relays(statuses, events) + machine_events:
+        notify(format_event(ev), key=event_key(ev))
+
+def prune_statuses(statuses, hosts):
     # Удалим из statuses ключи, которые больше не присутствуют в hosts.yaml (чтобы не расти бесконтрольно)
-    current_keys = set(f"{h['host']}:{h['port']}" for h in hosts)
+    current_keys = set(host_key(h) for h in hosts)
+    current_keys |= set(group_key(h["group"]) for h in hosts if h.get("group"))
     removed = []
     for k in list(statuses.keys()):
-        if k not in current_keys:
+        if k not in current_keys and not is_meta_key(k):
             removed.append(k)
             del statuses[k]
+            _histories.pop(k, None)
+            _latencies.pop(k, None)
     if removed:
         print("[INFO] Removed stale statuses for keys:", removed)
 
+def needs_confirmation(rec):
+    # Фейлы только начались, OFFLINE ещё не объявлен — перепроверяем сразу, не дожидаясь следующего цикла
+    if CONFIRM_PROBES <= 0 or not rec or rec.get("combined") == "offline":
+        return False
+    fails = rec.get("consec_fails") or 0
+    # Порог-длительность подтверждаем, пока она не набрана; порог-счётчик — не больше CONFIRM_PROBES раз
+    return fails > 0 and (FAIL_AFTER_SEC is not None or fails <= CONFIRM_PROBES)
+
+def confirmation_targets(statuses, hosts):
+    # Хосты для подтверждающей проверки; машину перепроверяем целиком, по её собственной записи
+    return [h for h in hosts
+            if needs_confirmation(statuses.get(group_key(h["group"]) if h.get("group") else host_key(h)))]
+
+def confirm_failures(hosts, statuses):
+    # До CONFIRM_PROBES быстрых перепроверок с шагом CONFIRM_DELAY_SEC в этом же запуске;
+    # каждая идёт в consec_fails (и в длительность серии), так что OFFLINE объявляется за секунды,
+    # а не за FAIL_THRESHOLD циклов.
+    # Здоровые хосты дополнительной нагрузки не получают
+    for attempt in range(CONFIRM_PROBES):
+        suspects = confirmation_targets(statuses, hosts)
+        if not suspects:
+            return
+        time.sleep(CONFIRM_DELAY_SEC)
+        print(f"[INFO] Confirmation probe {attempt + 1}/{CONFIRM_PROBES} for {len(suspects)} hosts")
+        process_results(statuses, suspects, probe_hosts(with_timeouts(statuses, suspects)))
+
+def run_cycle(hosts, statuses):
+    # Сначала опрашиваем все хосты параллельно, затем последовательно применяем hysteresis
+    t0 = time.monotonic()
+    results = probe_hosts(with_timeouts(statuses, hosts))
+    print(f"[INFO] Probed {len(hosts)} hosts in {time.monotonic() - t0:.2f}s (engine={PROBE_ENGINE})")
+    process_results(statuses, hosts, results)
+
+def file_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+def unit_interval(hosts, unit, default):
+    # Машина проверяется с самым коротким интервалом среди её путей
+    return min(hosts[i].get("interval") or default for i in unit)
+
+def build_schedule(hosts, default_interval, start):
+    # Куча (due, seq, индексы hosts) — по записи на машину или одиночный хост.
+    # Стартовые фазы разнесены равномерно по интервалу, чтобы проверки не шли пачкой
+    units = probe_units(hosts)
+    heap = []
+    for seq, unit in enumerate(units):
+        interval = unit_interval(hosts, unit, default_interval)
+        heap.append((start + interval * seq / len(units), seq, unit))
+    heapq.heapify(heap)
+    return heap
+
+def run_daemon(interval=CHECK_INTERVAL_SEC):
+    # Резидентный режим: состояние живёт в памяти, проверки идут по таймерам
+    # (у каждого хоста свой interval), на диск — раз в PERSIST_INTERVAL_SEC и при остановке
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+
+    statuses = load_statuses()
+    hosts, hosts_mtime = load_hosts(), file_mtime(HOSTS_FILE)
+    prune_statuses(statuses, hosts)
+    schedule = build_schedule(hosts, interval, time.monotonic())
+    last_save = time.monotonic()
+    print(f"[INFO] Daemon started: {len(hosts)} hosts, default interval {interval}s")
+    try:
+        while not stop.is_set():
+            # hosts.yaml перечитываем только если файл изменился
+            mtime = file_mtime(HOSTS_FILE)
+            if mtime != hosts_mtime:
+                hosts, hosts_mtime = load_hosts(), mtime
+                prune_statuses(statuses, hosts)
+                schedule = build_schedule(hosts, interval, time.monotonic())
+                print(f"[INFO] Reloaded {HOSTS_FILE}: {len(hosts)} hosts")
+
+            # Всё, что подошло по времени (с небольшим запасом), проверяем одной пачкой
+            now = time.monotonic()
+            due = []
+            while schedule and schedule[0][0] <= now + SCHEDULE_SLACK_SEC:
+                due.append(heapq.heappop(schedule))
+            if due:
+                run_cycle([hosts[i] for _, _, unit in due for i in unit], statuses)
+                now = time.monotonic()
+                for t, seq, unit in due:
+                    # Если проверка затянулась — не "догоняем", а сдвигаем расписание
+                    nxt = max(t + unit_interval(hosts, unit, interval), now)
+                    # Начавшиеся фейлы подтверждаем через CONFIRM_DELAY_SEC, а не через полный интервал
+                    if confirmation_targets(statuses, [hosts[i] for i in unit]):
+                        nxt = min(nxt, now + CONFIRM_DELAY_SEC)
+                    heapq.heappush(schedule, (nxt, seq, unit))
+
+            # Новые уведомления и созревшие повторы из outbox — фоновому отправителю
+            if due:
+                update_board(statuses)
+            flush_outbox(DIGEST_WINDOW_SEC)
+
+            if now - last_save >= PERSIST_INTERVAL_SEC:
+                save_statuses(statuses)
+                last_save = now
+            wait = schedule[0][0] - time.monotonic() if schedule else interval
+            # Просыпаемся не реже раза в 5 с, чтобы заметить изменения hosts.yaml
+            stop.wait(min(max(0.0, wait), 5.0))
+    finally:
+        deliver_outbox()
+        save_statuses(statuses)
+        close_state_db()
+        print("[DONE] Daemon stopped, statuses saved to", STATE_DB if STATE_BACKEND == "sqlite" else STATUS_FILE)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="TCP monitor for hosts.yaml")
+    parser.add_argument("--daemon", action="store_true",
+                        help="run cycles in-process on a timer instead of a single check")
+    parser.add_argument("--interval", type=parse_duration, default=CHECK_INTERVAL_SEC,
+                        help="default check interval in daemon mode for hosts without their own "
+                             "`interval` (default: CHECK_INTERVAL_SEC)")
+    args = parser.parse_args(argv)
+
+    if args.daemon:
+        run_daemon(args.interval)
+        return
+
+    hosts = load_hosts()
+    statuses = load_statuses()
+    run_cycle(hosts, statuses)
+    confirm_failures(hosts, statuses)
+    prune_statuses(statuses, hosts)
+    update_board(statuses)
+    deliver_outbox()
     save_statuses(statuses)
-    print("[DONE] Statuses saved to", STATUS_FILE)
+    close_state_db()
+    print("[DONE] Statuses saved to", STATE_DB if STATE_BACKEND == "sqlite" else STATUS_FILE)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+tg_stub.py — локальная заглушка Telegram Bot API для нагрузочных тестов уведомлений:
+- sendMessage / editMessageText / pinChatMessage с ответами в формате Bot API
+- задержка ответа (--latency-ms, --jitter-ms)
+- 429 с parameters.retry_after: лимит сообщений в секунду (--rate) и/или случайно (--p429)
+- случайные 5xx (--p5xx) и обрывы соединения RST (--preset)
+- GET /stats — счётчики и время получения каждого сообщения, POST /reset — обнулить
+
+Монитор направляется сюда через TELEGRAM_API_BASE=http://127.0.0.1:8081.
+С --bench заглушка сама прогоняет N уведомлений через outbox монитора и печатает
+пропускную способность и задержку доставки.
+"""
+import os
+import argparse
+import json
+import random
+import re
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubState:
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.rng = random.Random(args.seed)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.next_id = 1
+            self.messages = {}       # (chat_id, message_id) -> text
+            self.received = []       # (time.time(), method, text) принятых запросов
+            self.counts = {}         # "method status" -> N
+            self.tokens = float(self.args.burst)
+            self.refilled = time.monotonic()
+
+    def count(self, method, status):
+        key = f"{method} {status}"
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def take_token(self):
+        # -> 0, если сообщение укладывается в --rate, иначе сколько секунд ждать
+        if self.args.rate <= 0:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(float(self.args.burst), self.tokens + (now - self.refilled) * self.args.rate)
+        self.refilled = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return max(1, int((1 - self.tokens) / self.args.rate + 0.999))
+
+    def stats(self):
+        with self.lock:
+            return {"counts": dict(self.counts), "messages": len(self.messages),
+                    "received": [{"t": t, "method": m, "text": text} for t, m, text in self.received]}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"     # keep-alive, как у requests.Session
+    state = None
+
+    def log_message(self, fmt, *args):
+        if self.state.args.verbose:
+            super().log_message(fmt, *args)
+
+    def reply(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def error(self, status, description, **extra):
+        self.reply(status, dict({"ok": False, "error_code": status, "description": description}, **extra))
+
+    def reset_connection(self):
+        # SO_LINGER 0 + close — ядро отправляет RST вместо FIN
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        self.connection.close()
+        self.close_connection = True
+
+    def do_GET(self):
+        if self.path == "/stats":
+            return self.reply(200, self.state.stats())
+        self.error(404, "Not Found")
+
+    def do_POST(self):
+        st, args = self.state, self.state.args
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.path == "/reset":
+            st.reset()
+            return self.reply(200, {"ok": True})
+        m = re.fullmatch(r"/bot[^/]+/(\w+)", self.path)
+        if not m:
+            return self.error(404, "Not Found")
+        method = m.group(1)
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            return self.error(400, "Bad Request: can't parse JSON")
+
+        delay = args.latency_ms + st.rng.uniform(-args.jitter_ms, args.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        with st.lock:
+            roll = st.rng.random()
+            if roll < args.preset:
+                st.count(method, "reset")
+                return self.reset_connection()
+            roll -= args.preset
+            if roll < args.p5xx:
+                st.count(method, 502)
+                return self.error(502, "Bad Gateway")
+            roll -= args.p5xx
+            wait = st.take_token() if method in ("sendMessage", "editMessageText") else 0
+            if wait or roll < args.p429:
+                wait = wait or args.retry_after
+                st.count(method, 429)
+                return self.error(429, f"Too Many Requests: retry after {wait}",
+                                  parameters={"retry_after": wait})
+            status, result = self.call(method, payload)
+            st.count(method, status)
+            if status == 200:
+                st.received.append((time.time(), method, payload.get("text", "")))
+        if status != 200:
+            return self.error(status, result)
+        self.reply(200, {"ok": True, "result": result})
+
+    def call(self, method, payload):
+        # Вызывается под state.lock -> (HTTP-статус, result или описание ошибки)
+        st = self.state
+        chat = str(payload.get("chat_id"))
+        if method == "sendMessage":
+            if not payload.get("text"):
+                return 400, "Bad Request: message text is empty"
+            if len(payload["text"]) > 4096:
+                return 400, "Bad Request: message is too long"
+            message_id, st.next_id = st.next_id, st.next_id + 1
+            st.messages[(chat, message_id)] = payload["text"]
+            return 200, {"message_id": message_id, "chat": {"id": chat}, "date": int(time.time()),
+                         "text": payload["text"]}
+        if method == "editMessageText":
+            key = (chat, payload.get("message_id"))
+            if key not in st.messages:
+                return 400, "Bad Request: message to edit not found"
+            if st.messages[key] == payload.get("text"):
+                return 400, "Bad Request: message is not modified"
+            st.messages[key] = payload.get("text")
+            return 200, {"message_id": key[1], "chat": {"id": chat}, "text": payload.get("text")}
+        if method == "pinChatMessage":
+            return 200, True
+        return 404, "Not Found: method not found"
+
+
+def serve(args):
+    StubHandler.state = StubState(args)
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    server.daemon_threads = True
+    return server
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+def bench(args):
+    # Монитор импортируется после настройки env: его параметры читаются при импорте
+    server = serve(args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    workdir = tempfile.mkdtemp(prefix="tg-bench-")
+    os.environ.update({"TELEGRAM_API_BASE": f"http://{args.host}:{server.server_address[1]}",
+                       "TELEGRAM_BOT_TOKEN": "bench", "TELEGRAM_CHAT_ID": "1",
+                       "OUTBOX_FILE": os.path.join(workdir, "outbox.json"),
+                       "OUTBOX_BACKOFF_SEC": os.getenv("OUTBOX_BACKOFF_SEC", "0.2")})
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import monitor
+
+    queued = {}
+    t0 = time.time()
+    for i in range(args.bench):
+        queued[f"bench-{i}"] = time.time()
+        monitor.notify(f"⚠️ <b>bench-{i} OFFLINE</b>\nHost: <code>127.0.0.1:{10000 + i}</code>", key=f"bench-{i}")
+    delivered = monitor.deliver_outbox(args.deadline)
+    elapsed = time.time() - t0
+
+    stats = StubHandler.state.stats()
+    latency = {}
+    for rec in stats["received"]:
+        for ident in re.findall(r"bench-\d+", rec["text"]):
+            latency.setdefault(ident, (rec["t"] - queued[ident]) * 1000)
+    lat = list(latency.values())
+    print(f"[BENCH] {len(latency)}/{args.bench} alerts delivered in {elapsed:.2f}s "
+          f"({len(latency) / elapsed:.1f} alerts/s), all delivered: {delivered}")
+    print(f"[BENCH] HTTP calls: {stats['counts']}")
+    if lat:
+        print(f"[BENCH] alert latency ms p50/p95/max: {percentile(lat, 50):.1f}/"
+              f"{percentile(lat, 95):.1f}/{max(lat):.1f}")
+    server.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local Telegram Bot API stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081, help="0 — любой свободный")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="задержка каждого ответа")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="± случайная добавка к задержке")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="сообщений в секунду до 429 (0 — без лимита), как у реального API ~1/с на чат")
+    parser.add_argument("--burst", type=int, default=1, help="запас сообщений сверх --rate")
+    parser.add_argument("--p429", type=float, default=0.0, help="доля случайных 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after для случайных 429")
+    parser.add_argument("--p5xx", type=float, default=0.0, help="доля ответов 502")
+    parser.add_argument("--preset", type=float, default=0.0, help="доля обрывов соединения (RST)")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--verbose", action="store_true", help="логировать каждый запрос")
+    parser.add_argument("--bench", type=int, default=0, metavar="N",
+                        help="прогнать N уведомлений через outbox монитора и выйти")
+    parser.add_argument("--deadline", type=float, default=60.0, help="лимит доставки для --bench, с")
+    args = parser.parse_args(argv)
+
+    if args.bench:
+        if args.port == 8081:
+            args.port = 0
+        bench(args)
+        return
+    server = serve(args)
+    print(f"[INFO] Telegram stub on http://{args.host}:{server.server_address[1]} "
+          f"(latency {args.latency_ms}±{args.jitter_ms}ms, rate {args.rate}/s, "
+          f"p429 {args.p429}, p5xx {args.p5xx}, reset {args.preset})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()